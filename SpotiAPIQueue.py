@@ -1,7 +1,15 @@
+import logging
 import threading
-from concurrent.futures import ThreadPoolExecutor
-import ratelimitqueue
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 from queue import Empty
+from spoticolor import metrics
+from spoticolor.rateLimiter import AdaptiveRateLimiter
+from spoticolor.fairQueue import FairQueue, INTERACTIVE, BACKGROUND
+
+SHUTDOWN = '_shutdown'  # lane served last, so workers finish queued work before stopping
+
+log = logging.getLogger(__name__)
 
 
 class SpotiAPIQueue:
@@ -12,8 +20,9 @@ class SpotiAPIQueue:
             429: "The app has exceeded its rate limits",  # Slow down
         }
 
-        def __init__(self, status_code: int):
+        def __init__(self, status_code: int, retry_after=None):
             self.status_code = status_code
+            self.retry_after = retry_after
             self.message = self.ERROR_MESSAGES.get(
                 status_code, f"An error occurred with status code: {status_code}")
             super().__init__(self.message)
@@ -22,11 +31,12 @@ class SpotiAPIQueue:
     _lock = threading.Lock()
 
     @staticmethod
-    def get_instance():
+    def get_instance(**kwargs):
+        """ kwargs configure the queue the first time it is created """
         if SpotiAPIQueue._instance is None:
             with SpotiAPIQueue._lock:
                 if SpotiAPIQueue._instance is None:
-                    SpotiAPIQueue._instance = SpotiAPIQueue()
+                    SpotiAPIQueue._instance = SpotiAPIQueue(**kwargs)
         return SpotiAPIQueue._instance
 
     @staticmethod
@@ -36,50 +46,96 @@ class SpotiAPIQueue:
                 SpotiAPIQueue._instance.shutdown()
                 SpotiAPIQueue._instance = None
 
-    def __init__(self, calls: int = 2, per: float = .5, num_workers: int = 4):
+    def __init__(self, calls: int = 2, per: float = .5, num_workers: int = 4, max_throttle_retries: int = 5):
+        """
+        calls / per: starting rate budget, the limiter adapts it to the 429s Spotify sends back
+        max_throttle_retries: times a request is re-enqueued after a 429 before it is dropped
+        """
         if SpotiAPIQueue._instance is not None:
             raise Exception("Es un Singleton bro")
 
-        self.queue = ratelimitqueue.RateLimitQueue(calls=calls, per=per)
+        self.queue = FairQueue(lanes=(INTERACTIVE, BACKGROUND, SHUTDOWN))
+        self.limiter = AdaptiveRateLimiter.get_instance(rate=calls / per, burst=calls)
+        self.max_throttle_retries = max_throttle_retries
         self.num_workers = num_workers
         self.shutdown_flag = False
         self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        metrics.CallbackGauge('spoticolor_queue_depth', "Requests waiting in the queue", ['lane'], self.lane_depths)
+        metrics.CallbackGauge('spoticolor_queue_workers', "Queue worker threads", func=lambda: self.num_workers)
+        metrics.CallbackGauge('spoticolor_rate_limit', "Requests per second the adaptive limiter currently allows",
+                              func=lambda: self.limiter.rate)
         self.start_workers()
 
     def start_workers(self):
         for _ in range(self.num_workers):
             self.executor.submit(self.worker, self.queue)
 
-    def worker(self, rlq: ratelimitqueue.RateLimitQueue):
+    def worker(self, q: FairQueue):
         """Processes items from the queue until it is empty."""
         while True:
+            # wait for the rate limit before picking, so the request sent is the most urgent one at that moment
+            self.limiter.acquire()
             try:
-                user_id, func, args, kwargs, callback = rlq.get(timeout=1)
-                if func is None:  # Shutdown signal
-                    print(
-                        f"Worker {threading.current_thread().name} received shutdown signal")
-                    rlq.task_done()
-                    break
-                print(
-                    f"Worker {threading.current_thread().name} processing request for user {user_id}")
-                try:
-                    response = func(*args, **kwargs)
-                    if callback:
-                        callback(user_id, response)
-                except Exception as e:
-                    print(f"Error processing request for user {user_id}: {e}")
-                    rlq.task_done()
-                finally:
-                    rlq.task_done()
-                    print(
-                        f"Worker {threading.current_thread().name} finished request for user {user_id}")
+                user_id, func, args, kwargs, callback, future, attempt, lane, enqueued = q.get(timeout=1)
             except Empty:
+                self.limiter.refund()
                 if self.shutdown_flag:
                     break
+                continue
+            if func is None:  # Shutdown signal
+                self.limiter.refund()
+                log.info("Worker %s received shutdown signal", threading.current_thread().name)
+                q.task_done()
+                break
+            started = time.perf_counter()
+            sent = time.monotonic()  # the limiter's clock
+            metrics.QUEUE_WAIT.observe(started - enqueued, lane=lane)
+            metrics.WORKER_BUSY.inc()
+            log.debug("Worker %s processing request for user %s", threading.current_thread().name, user_id)
+            try:
+                response = func(*args, **kwargs)
+                self.limiter.onSuccess()
+                future.set_result(response)
+                if callback:
+                    callback(user_id, response)
+            except Exception as e:
+                if getattr(e, 'status_code', None) == 429 and attempt < self.max_throttle_retries:
+                    # back everyone off and put the request back instead of losing it
+                    self.limiter.onThrottle(getattr(e, 'retry_after', None), sent)
+                    metrics.QUEUE_THROTTLED.inc()
+                    log.info("Throttled, re-enqueuing request for user %s (retry after %ss)", user_id, getattr(e, 'retry_after', None))
+                    q.put((user_id, func, args, kwargs, callback, future, attempt + 1, lane, time.perf_counter()), user_id, lane)
+                else:
+                    metrics.QUEUE_ERRORS.inc(lane=lane)
+                    log.warning("Error processing request for user %s: %s", user_id, e)
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                q.task_done()
+                metrics.WORKER_BUSY.dec()
+                metrics.WORKER_BUSY_SECONDS.inc(time.perf_counter() - started)
+                log.debug("Worker %s finished request for user %s", threading.current_thread().name, user_id)
+
+    def enqueue_request(self, user_id: str, func, args: tuple, kwargs: dict, callback=None, lane: str = BACKGROUND) -> Future:
+        """
+        Returns a Future resolved with func's response (or its exception), callback is still called on success.
+        lane: INTERACTIVE for requests a page render waits on, BACKGROUND for yanks
+        """
+        log.debug("Enqueuing %s request for user %s", lane, user_id)
+        metrics.QUEUE_ENQUEUED.inc(lane=lane)
+        future = Future()
+        self.queue.put((user_id, func, args, kwargs, callback, future, 0, lane, time.perf_counter()), user_id, lane)
+        return future
+
+    def set_user_weight(self, user_id: str, weight: int):
+        """ Requests user_id gets per round-robin turn within a lane """
+        self.queue.setWeight(user_id, weight)
 
-    def enqueue_request(self, user_id: str, func, args: tuple, kwargs: dict, callback=None):
-        print(f"Enqueuing request for user {user_id}")
-        self.queue.put((user_id, func, args, kwargs, callback))
+    def lane_depths(self):
+        """ {lane: queued requests} """
+        depths = self.queue.depth()
+        depths.pop(SHUTDOWN, None)
+        return depths
 
     def is_queue_empty(self):
         return self.queue.empty()
@@ -90,7 +146,7 @@ class SpotiAPIQueue:
             self.shutdown_flag = True
             # Send shutdown signals to all worker threads
             for _ in range(self.num_workers):
-                self.queue.put((None, None, None, None, None))
+                self.queue.put((None, None, None, None, None, None, 0, SHUTDOWN, time.perf_counter()), None, SHUTDOWN)
             # Wait for all tasks to be completed
             self.queue.join()
             # Shut down the thread pool
@@ -1,10 +1,16 @@
-from typing import Dict
-from time import sleep
+from typing import Dict, Optional
 import requests
 import json
 import base64
-from spoticolor.auth import refresh_auth
+import hashlib
+import os
 from spoticolor.SpotiAPIQueue import SpotiAPIQueue
+from spoticolor.fairQueue import BACKGROUND
+from spoticolor.httpPool import SessionPool
+from spoticolor.responseCache import ResponseCache
+from spoticolor.tokenManager import TokenManager, ANY_HEADER
+from spoticolor.singleFlight import SingleFlight
+from spoticolor import metrics
 import time
 
 
@@ -27,51 +33,84 @@ class SpotifyAPI:
             # TODO: catch all possible errors of all methods
         }
 
-        def __init__(self, status_code):
+        def __init__(self, status_code, retry_after=None):
             self.status_code = status_code
+            self.retry_after = retry_after  # seconds from the Retry-After header on 429
             self.message = self.ERROR_MESSAGES.get(
                 status_code, f"An error occurred with status code: {status_code}")
             super().__init__(self.message)
 
     def __init__(self):
-        self.header = None
         self.refresh_token = None
+        self.user_key = None
         self.max_retry_auth = 1
-        self.url = "https://api.spotify.com/v1/"
+        # SPOTICOLOR_API_URL points the client at another server, e.g. mockSpotify.py
+        self.url = os.environ.get("SPOTICOLOR_API_URL", "https://api.spotify.com/v1/")
 
         self.queue = SpotiAPIQueue.get_instance()
+        self.http = SessionPool.get_instance()
+        self.cache = ResponseCache.get_instance()
+        self.tokens = TokenManager.get_instance()
+        self.inflight = SingleFlight.get_instance()
 
-    def set_header(self, header: Dict[str, str], refresh_token: str) -> None:
-        self.header = header
+    def set_header(self, header: Dict[str, str], refresh_token: str, user_id: Optional[str] = None,
+                   expires_in: Optional[float] = None) -> None:
+        """
+        user_id: spotify id of the user, keys their token and cached me/* responses (defaults to a hash of refresh_token)
+        expires_in: seconds until header expires, as returned by AuthHandler.authorize
+        """
         self.refresh_token = refresh_token
-
-    def refresh_auth_token(self):
-        print(f"refreshing auth for user {self.header}")
-        new_header = refresh_auth(self.refresh_token)
-        print(f"refreshed auth: {new_header is not None}")
-        self.header = new_header if new_header is not None else self.header
+        self.user_key = user_id or hashlib.sha1(str(refresh_token).encode()).hexdigest()
+        self.tokens.register(self.user_key, header, refresh_token, expires_in)
+
+    @property
+    def header(self) -> Optional[Dict[str, str]]:
+        """ The user's current header from the TokenManager, refreshed shortly before it expires """
+        if self.user_key is None:
+            return None
+        return self.tokens.header(self.user_key)
+
+    def refresh_auth_token(self, stale_header=ANY_HEADER):
+        """ stale_header: the header that got a 401, if another request already replaced it nothing is refreshed """
+        print(f"refreshing auth for user {self.user_key}")
+        refreshed = self.tokens.refresh(self.user_key, stale_header)
+        print(f"refreshed auth: {refreshed}")
 
     def handleErrors(func):
         def wrapper(self, *args, **kwargs):
             retries = 0
+            header = self.header
             response = func(self, *args, **kwargs)
             if response.status_code == 401:
                 while retries < self.max_retry_auth:
                     retries += 1
                     print(f"retrying for the {retries} time to refresh auth")
-                    sleep(0.5)
-                    self.refresh_auth_token()
+                    self.refresh_auth_token(header)
+                    header = self.header
                     response = func(self, *args, **kwargs)
-                    if response.status_code == 200:
-                        return response.json()
-            if response.status_code != 200:
-                raise SpotifyAPI.APIError(response.status_code)
-            return response.json()
+                    if response.status_code in (200, 304):
+                        return response
+            if response.status_code not in (200, 304):
+                raise SpotifyAPI.APIError(response.status_code, response.headers.get('Retry-After'))
+            return response
         return wrapper
 
     @handleErrors
+    def fetch(self, endpoint, params=None, etag=None) -> requests.Response:
+        """
+        Raw GET of endpoint, 304 if etag is given and the resource did not change.
+        """
+        headers = self.header if etag is None else {**self.header, 'If-None-Match': etag}
+        # pooled keep-alive connections, response.timings has the connect/tls/transfer split
+        response = self.http.get(self.url + endpoint, headers=headers, params=params)
+        label = metrics.endpointLabel(endpoint)
+        metrics.API_LATENCY.observe(response.timings['total'], endpoint=label)
+        metrics.API_RESPONSES.inc(endpoint=label, status=response.status_code)
+        return response
+
     def makeRequest(self, endpoint, params=None):
-        return requests.get(self.url + endpoint, headers=self.header, params=params)
+        """ Decoded json of endpoint, through the response cache """
+        return self.cache.request(self, endpoint, params)
 
     def getUser(self):
         return self.makeRequest('me')
@@ -79,8 +118,19 @@ class SpotifyAPI:
     def getUserPlaylists(self, limit=20, offset=0):
         return self.makeRequest('me/playlists', params={'limit': limit, 'offset': offset})
 
-    def enqueue_request(self, user_id, func, args, kwargs, callback):
-        self.queue.enqueue_request(user_id, func, args, kwargs, callback)
+    def enqueue_request(self, user_id, func, args, kwargs, callback=None, lane=BACKGROUND):
+        """ Returns a concurrent.futures.Future of the response """
+        return self.queue.enqueue_request(user_id, func, args, kwargs, callback, lane)
+
+    def enqueue_shared_request(self, user_id, func, args=(), kwargs=None, lane=BACKGROUND):
+        """
+        enqueue_request for catalog reads, whose response is the same for every user.
+        While an identical request (same method and arguments) is queued or running, its Future is returned
+        instead of enqueueing another one, so concurrent yanks sharing tracks fetch each of them once.
+        """
+        kwargs = kwargs or {}
+        key = (func.__name__, tuple(args), tuple(sorted(kwargs.items())))
+        return self.inflight.submit(key, lambda: self.enqueue_request(user_id, func, args, kwargs, lane=lane))
 
     # USER ENDPOINTS ----------------------------------------------------------
 
@@ -256,6 +306,15 @@ class SpotifyAPI:
         """
         return self.makeRequest(f'tracks/{trackID}')
 
+    # https://developer.spotify.com/documentation/web-api/reference/get-several-tracks
+    def getTracks(self, trackIDs):
+        """
+        /tracks
+        OAuth2.0 get several tracks, needs Authentication
+        trackIDs: list of max 50 track id strings
+        """
+        return self.makeRequest('tracks', params={'ids': ','.join(trackIDs)})
+
     # Search and Recommendations ENDPOINTS ------------------------------------
 
     # https://developer.spotify.com/documentation/web-api/reference/get-recommendations
@@ -1,15 +1,18 @@
-from flask import Flask, request, redirect, url_for, render_template, session, jsonify,  make_response
+from flask import Flask, Response, abort, request, redirect, url_for, render_template, session, jsonify,  make_response
+import json
 import os
 from logging.config import dictConfig
 from datetime import datetime
-import threading
 
 from spoticolor.auth import AuthHandler
 from spoticolor.secret import hostname
-from spoticolor.storage import Storage
+from spoticolor.storage import Storage, encodeTrack
 from spoticolor.api import SpotifyAPI
-from spoticolor.dataYanker import dataYanker
+from spoticolor.fairQueue import INTERACTIVE
+from spoticolor.responseCache import ResponseCache
+from spoticolor.dataYanker import dataYanker, startYank, resumeYanks
 from spoticolor import vis
+from spoticolor import metrics
 
 # init flask
 app = Flask(__name__)
@@ -48,14 +51,16 @@ def auth():
 def callback():
     api = SpotifyAPI()
     auth_token = request.args['code']
-    auth_header, refresh_token = auth_client.authorize(auth_token)
+    auth_header, refresh_token, expires_in = auth_client.authorize(auth_token)
     print(f"auth_header: {auth_header}")
     print(f"refresh_token: {refresh_token}")
-    api.set_header(auth_header, refresh_token)
+    api.set_header(auth_header, refresh_token, expires_in=expires_in)
     session["auth_header"] = auth_header
     session["refresh_token"] = refresh_token
     session['name'] = api.getUser()
     session["userid"] = session["name"]["id"]
+    # from here on the token is managed under the spotify user id, refreshed before it expires
+    api.set_header(auth_header, refresh_token, session["userid"], expires_in)
     session["username"] = session["name"]["display_name"]
     session["yanked_data"] = False
     print(f"session['name']: {session['name']}", session)
@@ -70,6 +75,11 @@ def valid_token(resp):
     return resp is not None and not 'error' in resp
 
 
+def interactive(api, func, *args, **kwargs):
+    """ Enqueues a request a page render waits on, served ahead of the background yanks. Returns its Future """
+    return api.enqueue_request(session.get("userid"), func, args, kwargs, lane=INTERACTIVE)
+
+
 @app.route("/")
 def index():
     model2_cookie = request.cookies.get('model2')
@@ -89,8 +99,8 @@ def model2():
     if not session["yanked_data"]:
         yanker = dataYanker(
             session['auth_header'], session["userid"], session["refresh_token"])
-        t1 = threading.Thread(target=yanker.yank, args=(storage,))
-        t1.start()
+        # resumes where an interrupted yank of this user stopped
+        startYank(yanker, storage)
         session["yanked_data"] = True
     return render_template("model2.html", userid=session["userid"], username=session["username"])
 
@@ -106,10 +116,26 @@ def check_dataset():
 def dash(trackid):
     if 'auth_header' in session and 'refresh_token' in session:
         api = SpotifyAPI()
-        api.set_header(session["auth_header"], session["refresh_token"])
-        analJSON = api.getTrackAudioAnalysis(trackid)
+        api.set_header(session["auth_header"], session["refresh_token"], session.get("userid"))
+        trackFuture = interactive(api, api.getTrack, trackid)
+        # analyses of yanked tracks are in storage, only unknown tracks go to the API (and are kept from then on)
+        stored = storage.getTrack(trackid)
+        analFuture = interactive(api, api.getTrackAudioAnalysis, trackid) if stored is None else None
+        try:
+            trackJSON = trackFuture.result()
+        except SpotifyAPI.APIError as e:
+            if e.status_code in (400, 404):  # malformed or unknown track id
+                abort(404)
+            raise
+        if trackJSON is None:
+            abort(404)
+
+        if stored is not None:
+            analJSON = json.loads(stored[1])
+        else:
+            analJSON = analFuture.result()
+            storage.addTracksBulk([encodeTrack(trackid, analJSON)])
         # featJSON = api.getTrackAudioFeatures(trackid)
-        trackJSON = api.getTrack(trackid)
 
         if not trackJSON["album"]["images"] is None:
             colors = vis.generate_colors(
@@ -163,13 +189,14 @@ def profile():
 
     if 'auth_header' in session and 'refresh_token' in session:
         api = SpotifyAPI()
-        api.set_header(session["auth_header"], session["refresh_token"])
-        # get profile data
-        profile_data = api.getUser()
-        # get user playlist data
-        playlist_data = api.getUserPlaylists()
-        # get user recently played tracks
-        recently_played = api.getRecentlyPlayed()
+        api.set_header(session["auth_header"], session["refresh_token"], session.get("userid"))
+        # profile data, fetched once at login
+        profile_data = session["name"]
+        # user playlist data and recently played tracks, fetched side by side
+        playlistFuture = interactive(api, api.getUserPlaylists)
+        recentFuture = interactive(api, api.getRecentlyPlayed)
+        playlist_data = playlistFuture.result()
+        recently_played = recentFuture.result()
         # session['name'] = profile_data['email']
         app.logger.info(f"Its easter: {api.nothing().status_code == 204}")
         hour = datetime.now().hour
@@ -197,9 +224,9 @@ def profile():
 def cube():
     if 'auth_header' in session and 'refresh_token' in session:
         api = SpotifyAPI()
-        api.set_header(session["auth_header"], session["refresh_token"])
+        api.set_header(session["auth_header"], session["refresh_token"], session.get("userid"))
         # TODO: replace with whatever we need
-        tracks = api.getRecentlyPlayed()
+        tracks = interactive(api, api.getRecentlyPlayed).result()
         trackItems = tracks["items"]
         seen = set()
         uniqueTrackItems = []
@@ -209,7 +236,7 @@ def cube():
                 uniqueTrackItems.append(track)
                 seen.add(trackID)
 
-        profile_data = api.getUser()
+        profile_data = session.get("name")
 
         if valid_token(tracks):
             return render_template('cube.html',
@@ -220,16 +247,30 @@ def cube():
     return render_template('cube.html')
 
 
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/contact')
 def contact():
     return render_template('contact.html')
 
 
+def resume_yanks():
+    # app.run(debug=True) imports the app twice, only the reloader's serving child resumes yanks
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        resumeYanks(storage)
+
+
 def startlocal():
     global storage, auth_client
     # Add objs to Flask's context
     port = 8080
     storage = Storage()
+    storage.createTables()
+    ResponseCache.get_instance(disk_path='cache.db')
+    resume_yanks()
     print(storage.fetch_all_users())
     auth_client = AuthHandler("http://localhost:"+str(port))
     app.run(debug=True, host='localhost', port=port)
@@ -239,6 +280,9 @@ def start():
     global storage, auth_client
     # Add objs to Flask's context
     storage = Storage()
+    storage.createTables()
+    ResponseCache.get_instance(disk_path='cache.db')
+    resume_yanks()
     auth_client = AuthHandler(hostname)
     app.run(debug=True, host=hostname.split("//")[1], port=80)
 
@@ -0,0 +1,50 @@
+import struct
+import numpy as np
+
+
+# Binary layout of every numpy array we keep in the db:
+#   magic (4s) | dtype str padded to 4 bytes (4s) | version (uint32) | ndim (uint32) | shape (ndim * uint64) | raw little-endian buffer
+MAGIC = b'SCA1'
+_HEADER = struct.Struct('<4s4sII')
+_DIM = struct.Struct('<Q')
+
+
+def encodeArray(array: np.ndarray, version: int = 0) -> bytes:
+    """
+    Serializes array to a header + contiguous little-endian buffer.
+    version: free for the caller, e.g. the model version that produced the array
+    """
+    array = np.asarray(array)
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    dtype = array.dtype.str.encode('ascii')
+    if len(dtype) > 4:
+        raise ValueError(f"Unsupported dtype for array blob: {array.dtype}")
+    header = _HEADER.pack(MAGIC, dtype.ljust(4, b'\x00'), version, array.ndim)
+    shape = b''.join(_DIM.pack(dim) for dim in array.shape)
+    return header + shape + array.tobytes()
+
+
+def isArrayBlob(blob) -> bool:
+    return isinstance(blob, (bytes, memoryview)) and bytes(blob[:4]) == MAGIC
+
+
+def readHeader(blob):
+    """
+    Returns (dtype, shape, version, data_offset) without touching the buffer.
+    """
+    magic, dtype, version, ndim = _HEADER.unpack_from(blob, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an array blob")
+    offset = _HEADER.size
+    shape = tuple(_DIM.unpack_from(blob, offset + i * _DIM.size)[0] for i in range(ndim))
+    offset += ndim * _DIM.size
+    return np.dtype(dtype.rstrip(b'\x00').decode('ascii')), shape, version, offset
+
+
+def decodeArray(blob) -> np.ndarray:
+    """
+    Zero-copy view over blob, the result is read only.
+    """
+    dtype, shape, _, offset = readHeader(blob)
+    count = int(np.prod(shape, dtype=np.int64))
+    return np.frombuffer(blob, dtype=dtype, count=count, offset=offset).reshape(shape)
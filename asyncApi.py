@@ -0,0 +1,184 @@
+from typing import Dict, Optional
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    import aiohttp
+except ImportError:  # only needed for the async client
+    aiohttp = None
+
+from spoticolor.api import SpotifyAPI
+from spoticolor.fairQueue import BACKGROUND
+from spoticolor.rateLimiter import AdaptiveRateLimiter
+from spoticolor import metrics
+
+
+class AsyncResponse:
+    """ The part of requests.Response that handleErrors and ResponseCache look at """
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncSession:
+    """
+    One event loop thread with one aiohttp session, shared by every AsyncSpotifyAPI in the process.
+    Requests in flight are bounded by a semaphore instead of a number of worker threads, and draw from the same
+    AdaptiveRateLimiter as the SpotiAPIQueue workers, so both paths together stay within one budget.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_instance(**kwargs):
+        """ kwargs configure the session the first time it is created """
+        if AsyncSession._instance is None:
+            with AsyncSession._lock:
+                if AsyncSession._instance is None:
+                    AsyncSession._instance = AsyncSession(**kwargs)
+        return AsyncSession._instance
+
+    def __init__(self, max_in_flight: int = 64, max_throttle_retries: int = 5, timeout: float = 20):
+        """
+        max_in_flight: requests sent or waiting for the rate limit at once, over all users
+        max_throttle_retries: times a request is sent again after a 429 before it fails
+        """
+        if aiohttp is None:
+            raise RuntimeError("The async Spotify client needs the aiohttp package")
+        self.max_in_flight = max_in_flight
+        self.max_throttle_retries = max_throttle_retries
+        self.limiter = AdaptiveRateLimiter.get_instance()
+        self.in_flight = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="spoticolor-async", daemon=True)
+        self.thread.start()
+        # the semaphore and the session belong to the loop, so they are created on it
+        self.submit(self._open(timeout)).result()
+        metrics.CallbackGauge('spoticolor_async_in_flight', "Requests the async client is running",
+                              func=lambda: self.in_flight)
+
+    async def _open(self, timeout):
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout),
+                                             connector=aiohttp.TCPConnector(limit=self.max_in_flight))
+
+    def submit(self, coroutine) -> Future:
+        """ Runs coroutine on the loop, returns a concurrent.futures.Future of its result """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def acquire(self):
+        """ AdaptiveRateLimiter.acquire without blocking the loop """
+        while True:
+            wait = self.limiter.reserve()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def send(self, user_id, func, args, kwargs, callback=None):
+        """
+        What a SpotiAPIQueue worker does with a request: waits for the shared rate budget,
+        awaits func(*args, **kwargs) and sends it again after a 429, once the limiter has backed everyone off.
+        """
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                await self.acquire()
+                sent = time.monotonic()  # the limiter's clock
+                self.in_flight += 1
+                try:
+                    response = await func(*args, **kwargs)
+                except Exception as e:
+                    if getattr(e, 'status_code', None) != 429 or attempt >= self.max_throttle_retries:
+                        raise
+                    self.limiter.onThrottle(getattr(e, 'retry_after', None), sent)
+                    attempt += 1
+                    continue
+                finally:
+                    self.in_flight -= 1
+            self.limiter.onSuccess()
+            if callback:
+                callback(user_id, response)
+            return response
+
+    async def get(self, url, headers=None, params=None) -> AsyncResponse:
+        # aiohttp only takes str query values, requests drops the Nones
+        params = {key: str(value) for key, value in (params or {}).items() if value is not None}
+        async with self.session.get(url, headers=headers, params=params) as response:
+            return AsyncResponse(response.status, response.headers, await response.read())
+
+    def close(self):
+        """ Closes the session and stops the loop thread """
+        self.submit(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def handleErrorsAsync(func):
+    """ SpotifyAPI.handleErrors for coroutines, the token refresh runs in a thread so the loop keeps going """
+    async def wrapper(self, *args, **kwargs):
+        retries = 0
+        header = await self.currentHeader()
+        response = await func(self, *args, **kwargs)
+        if response.status_code == 401:
+            while retries < self.max_retry_auth:
+                retries += 1
+                print(f"retrying for the {retries} time to refresh auth")
+                await asyncio.to_thread(self.refresh_auth_token, header)
+                header = await self.currentHeader()
+                response = await func(self, *args, **kwargs)
+                if response.status_code in (200, 304):
+                    return response
+        if response.status_code not in (200, 304):
+            raise SpotifyAPI.APIError(response.status_code, response.headers.get('Retry-After'))
+        return response
+    return wrapper
+
+
+class AsyncSpotifyAPI(SpotifyAPI):
+    """
+    SpotifyAPI whose requests run on the AsyncSession loop instead of the SpotiAPIQueue worker threads.
+    The endpoint methods are inherited unchanged, makeRequest is a coroutine here so they return awaitables.
+    enqueue_request still returns a concurrent.futures.Future, so dataYanker (checkpoints, resume, delta sync)
+    runs on this client as is.
+    """
+    def __init__(self, session: Optional[AsyncSession] = None):
+        super().__init__()
+        self.session = session if session is not None else AsyncSession.get_instance()
+
+    async def currentHeader(self) -> Optional[Dict[str, str]]:
+        """ self.header, a refresh shortly before the token expires runs in a thread """
+        if self.user_key is not None and self.tokens.needsRefresh(self.user_key):
+            return await asyncio.to_thread(lambda: self.header)
+        return self.header
+
+    @handleErrorsAsync
+    async def fetch(self, endpoint, params=None, etag=None) -> AsyncResponse:
+        """
+        Raw GET of endpoint, 304 if etag is given and the resource did not change.
+        """
+        header = await self.currentHeader()
+        headers = header if etag is None else {**header, 'If-None-Match': etag}
+        started = time.perf_counter()
+        response = await self.session.get(self.url + endpoint, headers=headers, params=params)
+        label = metrics.endpointLabel(endpoint)
+        metrics.API_LATENCY.observe(time.perf_counter() - started, endpoint=label)
+        metrics.API_RESPONSES.inc(endpoint=label, status=response.status_code)
+        return response
+
+    async def makeRequest(self, endpoint, params=None):
+        """ Decoded json of endpoint, through the response cache """
+        return await self.cache.requestAsync(self, endpoint, params)
+
+    def enqueue_request(self, user_id, func, args, kwargs, callback=None, lane=BACKGROUND):
+        """
+        Returns a concurrent.futures.Future of the response, func is one of this client's endpoint methods.
+        lane is accepted for SpotifyAPI's signature, requests on the loop are not queued behind each other.
+        """
+        return self.session.submit(self.session.send(user_id, func, args, kwargs, callback))
@@ -1,18 +1,23 @@
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 import urllib.parse as urllibparse
 import requests
 import base64
+import os
 
 
-# TODO handle auth tokens expiring
 # TODO error handling
 
+
+def accounts_url() -> str:
+    """ Spotify accounts service, SPOTICOLOR_ACCOUNTS_URL points it at another server, e.g. mockSpotify.py """
+    return os.environ.get("SPOTICOLOR_ACCOUNTS_URL", "https://accounts.spotify.com")
+
 class AuthHandler:
     """
     Handles anything authentication related
     """
     def __init__(self, host_url: str):
-        self.auth_url = "https://accounts.spotify.com/api/token"
+        self.auth_url = accounts_url() + "/api/token"
         self.host_url = host_url
         self.redirect_uri = self.host_url + "/callback"
         self.client_id, self.client_secret = self._get_secrets()
@@ -26,15 +31,18 @@ class AuthHandler:
         }
         self.url_args = "&".join(["{}={}".format(key, urllibparse.quote(val))
                                   for key, val in list(self.auth_query_parameters.items())])
-        self.redirect_url = "https://accounts.spotify.com/authorize/?{}".format(self.url_args)
+        self.redirect_url = accounts_url() + "/authorize/?{}".format(self.url_args)
 
     def _get_secrets(self) -> Tuple[str]:
         """ Read secrets from secret.py """
         from spoticolor.secret import CLIENT_ID, CLIENT_SECRET
         return CLIENT_ID, CLIENT_SECRET
 
-    def authorize(self, auth_token) -> Tuple[Dict, str]:
-        """ Given auth token of active user auth returns header to be used to make requests for that user. """
+    def authorize(self, auth_token) -> Tuple[Dict, str, int]:
+        """
+        Given auth token of active user auth returns header to be used to make requests for that user,
+        the refresh token and the seconds until the header expires.
+        """
         code_payload = {
             "grant_type": "authorization_code",
             "code": str(auth_token),
@@ -45,17 +53,14 @@ class AuthHandler:
         res = post_request.json()
         access_token, refresh_token = res["access_token"], res["refresh_token"]
         auth_header = {"Authorization": "Bearer {}".format(access_token)}
-        return auth_header, refresh_token
+        return auth_header, refresh_token, res.get("expires_in", 3600)
 
 
-def refresh_auth(refresh_token: str) -> Dict[str, str]:
+def refresh_grant(refresh_token: str) -> Optional[Dict]:
     """
-    Standalone function to refresh user auth token with refresh token since they expire
-    every hour.
-    Args:
-      refresh_token (str): user auth refresh token, used to get new auth token
+    Exchanges refresh_token for a new access token.
     Returns:
-      auth_header (Dict[str, str]): auth header to be used to authenticate API calls
+      {"header": auth header, "expires_in": seconds, "refresh_token": new refresh token or None}, None on failure
     """
     from spoticolor.secret import CLIENT_ID, CLIENT_SECRET
     base64_encoded = base64.b64encode(("{}:{}".format(CLIENT_ID, CLIENT_SECRET)).encode())
@@ -63,11 +68,28 @@ def refresh_auth(refresh_token: str) -> Dict[str, str]:
         "grant_type": "refresh_token",
         "refresh_token": refresh_token
     }
-    header = {"Authorization": "Basic" + str(base64_encoded)}
-    req = requests.post("https://accounts.spotify.com/api/token", data=code_payload, headers=header)
+    header = {"Authorization": "Basic {}".format(base64_encoded.decode())}
+    req = requests.post(accounts_url() + "/api/token", data=code_payload, headers=header)
     res = req.json()
     access_token = res.get("access_token")
     if not access_token:
-        print(req.status_code, req.json())
+        print(req.status_code, res)
         return None
-    return {"Authorization": f"Bearer {access_token}"}
+    return {
+        "header": {"Authorization": f"Bearer {access_token}"},
+        "expires_in": res.get("expires_in", 3600),
+        "refresh_token": res.get("refresh_token"),
+    }
+
+
+def refresh_auth(refresh_token: str) -> Dict[str, str]:
+    """
+    Standalone function to refresh user auth token with refresh token since they expire
+    every hour.
+    Args:
+      refresh_token (str): user auth refresh token, used to get new auth token
+    Returns:
+      auth_header (Dict[str, str]): auth header to be used to authenticate API calls
+    """
+    grant = refresh_grant(refresh_token)
+    return grant["header"] if grant is not None else None
@@ -1,10 +1,24 @@
+from typing import Dict, List
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import datetime
-from spoticolor.storage import Storage
+import os
+import threading
+from spoticolor.storage import Storage, encodeTrack
+from spoticolor.scaler import SegmentScaler
+from spoticolor.arrayBlob import decodeArray
 from spoticolor.api import SpotifyAPI
 from spoticolor.model1 import create_user_dataset
-import orjson
-import threading
-import time
+
+
+def ingestApi() -> SpotifyAPI:
+    """
+    Client the yanks send their requests through: the SpotiAPIQueue workers,
+    or with SPOTICOLOR_ASYNC_INGEST=1 the asyncio client (asyncApi), where requests in flight are not capped by threads.
+    """
+    if os.environ.get("SPOTICOLOR_ASYNC_INGEST") == "1":
+        from spoticolor.asyncApi import AsyncSpotifyAPI
+        return AsyncSpotifyAPI()
+    return SpotifyAPI()
 
 
 class dataYanker:
@@ -16,188 +30,277 @@ class dataYanker:
     def __init__(self, header, userid, refresh_token):
         self.header = header
         self.userid = userid
-        self.api = SpotifyAPI()
-        self.api.set_header(header, refresh_token)
+        self.refresh_token = refresh_token
+        self.api = ingestApi()
+        self.api.set_header(header, refresh_token, userid)
         self.track_IDs = set()
         self.artists = set()
+        self._ids_lock = threading.Lock()  # sources add their ids concurrently, see fetchSources
 
-        self.responses = []
-        self.completed = threading.Event()
-
-    def enqueue_and_wait(self, user_id, func, args=None, kwargs=None):
-        self.responses = []
-        self.completed.clear()
-
-        def callback(uid, response):
-            if uid == user_id:
-                self.responses.append(response)
-                if len(self.responses) == self.expected_responses:
-                    self.completed.set()
+    def collect(self, trackids):
+        """ Adds trackids to self.track_IDs, safe to call from every source thread """
+        with self._ids_lock:
+            self.track_IDs.update(trackids)
 
-        self.expected_responses = 1
-        self.api.enqueue_request(
-            user_id, func, args or [], kwargs or {}, callback)
-        self.completed.wait()
+    def fetch(self, func, *args, **kwargs) -> Future:
+        """ Enqueues func(*args, **kwargs) for this user, returns the Future of its response """
+        return self.api.enqueue_request(self.userid, func, args, kwargs)
 
-        return self.responses[0]
+    def enqueue_and_wait(self, user_id, func, args=None, kwargs=None):
+        return self.api.enqueue_request(user_id, func, args or [], kwargs or {}).result()
 
-    def yank(self, storage: Storage):
-        print("yank")
+    def iterPages(self, func, *args, offset=0, limit=50, **kwargs):
+        """
+        (offset, page) of every page of an offset paginated endpoint from offset on, in order.
+        Once the first page reveals the total all remaining pages are enqueued at once, so the queue workers fetch them in parallel.
+        """
+        first = self.fetch(func, *args, limit=limit, offset=offset, **kwargs).result()
+        futures = [(pageOffset, self.fetch(func, *args, limit=limit, offset=pageOffset, **kwargs))
+                   for pageOffset in range(offset + limit, first['total'], limit)]
+        yield offset, first
+        for pageOffset, future in futures:
+            yield pageOffset, future.result()
+
+    def fetchAllPages(self, func, *args, limit=50, **kwargs) -> List[Dict]:
+        """ Every page of an offset paginated endpoint """
+        return [page for _, page in self.iterPages(func, *args, limit=limit, **kwargs)]
+
+    def pagedSource(self, storage: Storage, source, func, extract, *args, limit=50, highWater=None, **kwargs):
+        """
+        Adds the track ids extract(page) of every page of func to self.track_IDs.
+        With storage every page is checkpointed under source, a resumed yank continues after the last stored page.
+        highWater: page -> sync_state of source, taken from the first page and saved with its checkpoint,
+        so a yank resumed further down still stores it once the source is done
+        """
+        offset = 0
+        if storage is not None:
+            offset, _, done = storage.getYankCheckpoint(self.userid, source)
+            if done:
+                return
+        for offset, page in self.iterPages(func, *args, offset=offset, limit=limit, **kwargs):
+            trackids = extract(page)
+            self.collect(trackids)
+            mark = highWater(page) if highWater is not None and offset == 0 else None
+            if storage is not None:
+                storage.saveYankCheckpoint(self.userid, source, trackids, next_offset=offset + limit, high_water=mark)
+        if storage is not None:
+            storage.saveYankCheckpoint(self.userid, source, [], next_offset=offset + limit, done=True)
+
+    def yank(self, storage: Storage, full=False):
         """
         Here all user data is pulled to populate self.track_IDs, then track IDs are saved to storage
+        and the user's dataset is built.
+        Progress is kept in the yank_jobs tables, a yank interrupted by a crash or restart resumes
+        at the stage, and within the sources at the page, where it stopped.
+        A returning user only gets what changed since their last sync (see sync_state), full=True refetches everything.
         """
-        print("started yanker...")
-        self.getAllSavedTracks()
-        print("Gotten all saved tracks")
-
-        self.getTop()
-        print("Gotten all top tracks")
-
-        # self.getPlaylistTracks()
-        print("Gotten all playlists tracks")
-
-        # self.getUserQueue() # TODO: FIX THIS, i get Bad OAuth request, yes read-queue not in auth scope
-
-        # self.getArtistTop()
-        print("Gotten all artists tracks")
-
-        self.getRecentlyPlayed()
-        print("Gotten all recently played tracks")
-
-        print(f"Extracted {len(self.track_IDs)} unique track ids from user")
-
-        self.store_track_ids(storage)
-        print("stored all tracks audio analysis")
+        if full:
+            storage.resetSyncState(self.userid)
+        stage = storage.startYankJob(self.userid, self.refresh_token)
+        print(f"started yanker at stage {stage}...")
+        try:
+            if stage == 'sources':
+                sync = storage.getSyncState(self.userid)
+                if sync:
+                    print(f"delta sync since {sync}")
+                self.fetchSources(storage, sync)
+
+                stage = 'analyses'
+                storage.setYankStage(self.userid, stage)
+
+            # ids of the pages fetched before a restart
+            self.track_IDs.update(storage.getYankTrackIds(self.userid))
+            print(f"Extracted {len(self.track_IDs)} unique track ids from user")
+
+            if stage == 'analyses':
+                self.store_track_ids(storage)
+                print("stored all tracks audio analysis")
+                stage = 'dataset'
+                storage.setYankStage(self.userid, stage)
+
+            if stage == 'dataset':
+                print("starting creating user dataset")
+                create_user_dataset(self.userid, max_tracks=750)
+                print("done creating user dataset")
+                storage.setYankStage(self.userid, 'done')
+        except Exception as e:
+            storage.setYankStage(self.userid, stage, 'failed', str(e))
+            raise
+
+    def fetchSources(self, storage: Storage = None, sync=None):
+        """
+        Runs every source at once, each in its own thread. The threads only wait on futures, so the requests
+        of all sources interleave in the queue under the shared rate budget, and every source adds its ids
+        to self.track_IDs as its pages arrive. A failing source fails the yank once the others finished,
+        their checkpoints are kept for the retry.
+        sync: high-water marks of the last sync, see Storage.getSyncState
+        """
+        sync = sync or {}
+        sources = {
+            'saved tracks': lambda: self.getAllSavedTracks(storage, since=sync.get('saved')),
+            'top tracks': lambda: self.getTop(storage=storage),
+            'playlists tracks': lambda: self.getPlaylistTracks(storage),
+            'artists tracks': lambda: self.getArtistTop(storage=storage),
+            'recently played tracks': lambda: self.getRecentlyPlayed(storage, since=sync.get('recently_played')),
+            # self.getUserQueue() # TODO: FIX THIS, i get Bad OAuth request, yes read-queue not in auth scope
+        }
+        with ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix=f"yank-{self.userid}") as pool:
+            futures = {pool.submit(source): name for name, source in sources.items()}
+            for future in as_completed(futures):
+                future.result()
+                print(f"Gotten all {futures[future]}")
+
+    def getAllSavedTracks(self, storage: Storage = None, since=None):
+        """
+        since: added_at high-water mark of the last sync, only tracks saved after it are fetched.
+        me/tracks is newest first, so paging stops at the first page that reaches it.
+        """
+        def newest(page):
+            return page["items"][0]["added_at"] if page["items"] else since
 
-        print("starting creating user dataset")
-        create_user_dataset(self.userid, max_tracks=750)
-        print("done creating user dataset")
+        if since is None:
+            self.pagedSource(storage, 'saved', self.api.getUserSavedTracks,
+                             lambda page: [item["track"]["id"] for item in page["items"]], highWater=newest)
+            print("finished extracting all saved tracks")
+            return
 
-    def getAllSavedTracks(self):
-        trackids = []
-        total = self.enqueue_and_wait(
-            self.userid, self.api.getUserSavedTracks)["total"]
-
-        x, rest = divmod(total, 50)
-        self.expected_responses = x + (1 if rest != 0 else 0)
-        for i in range(x + 1):
-            items = self.enqueue_and_wait(self.userid, self.api.getUserSavedTracks, kwargs={
-                                          "limit": 50, "offset": i*50})["items"]
-            for item in items:
-                trackids.append(item["track"]["id"])
-        self.track_IDs.update(trackids)
-        print("finished extracting all saved tracks")
-
-    def getTop(self, time_range='short_term', what='tracks'):
+        offset, mark, limit = 0, None, 50
+        if storage is not None and storage.getYankCheckpoint(self.userid, 'saved')[2]:
+            return
+        while True:
+            page = self.fetch(self.api.getUserSavedTracks, limit=limit, offset=offset).result()
+            mark = mark or newest(page)
+            fresh = [item for item in page["items"] if item["added_at"] > since]
+            trackids = [item["track"]["id"] for item in fresh]
+            self.collect(trackids)
+            last = len(fresh) < len(page["items"]) or offset + limit >= page["total"]
+            if storage is not None:
+                storage.saveYankCheckpoint(self.userid, 'saved', trackids, next_offset=offset + limit,
+                                           done=last, high_water=mark)
+            if last:
+                break
+            offset += limit
+        print(f"finished extracting saved tracks added since {since}")
+
+    def getTop(self, time_range='short_term', what='tracks', storage: Storage = None):
         """
         stores raw json from getTopTracks,
         time_range: 'short_term', 'medium_term', 'long_term'
         what: 'artists', 'tracks'
         """
-        total = self.enqueue_and_wait(self.userid, self.api.getUserTop, kwargs={
-                                      "requestType": what, "timeRange": time_range})["total"]
-        trackids = []
-
-        x, rest = divmod(total, 50)
-        for i in range(x):
-            items = self.enqueue_and_wait(self.userid, self.api.getUserTop, kwargs={
-                                          "requestType": what, "timeRange": time_range, "offset": i*50})["items"]
-            for item in items:
-                trackids.append(item["id"])
-        if rest != 0:
-            items = self.enqueue_and_wait(self.userid, self.api.getUserTop, kwargs={
-                                          "requestType": what, "timeRange": time_range, "offset": x*50})["items"]
-            for item in items:
-                trackids.append(item["id"])
-
-        self.track_IDs.update(trackids)
+        self.pagedSource(storage, f'top_{what}_{time_range}', self.api.getUserTop,
+                         lambda page: [item["id"] for item in page["items"]],
+                         requestType=what, timeRange=time_range)
         print("finished extracting all top", what)
 
-    def getPlaylistTracks(self):
+    def getPlaylistTracks(self, storage: Storage = None):
         """
-        gets list of all playlists and downloads all tracks from them
+        gets list of all playlists and downloads all tracks from them.
+        With storage a playlist whose snapshot_id did not change since it was last paged contributes
+        its stored track ids instead, only new and changed playlists are paged.
         """
+        if storage is not None and storage.getYankCheckpoint(self.userid, 'playlists')[2]:
+            return
         playlistsItems = []
         trackids = []
-        total = self.enqueue_and_wait(
-            self.userid, self.api.getUserPlaylists)['total']
-
-        x, rest = divmod(total, 50)
-        for i in range(x):
-            playlistsItems.extend(self.enqueue_and_wait(
-                self.userid, self.api.getUserPlaylists, kwargs={"limit": 50, "offset": i*50})['items'])
-        if rest != 0:
-            playlistsItems.extend(self.enqueue_and_wait(
-                self.userid, self.api.getUserPlaylists, kwargs={"limit": 50, "offset": x*50})['items'])
+        for page in self.fetchAllPages(self.api.getUserPlaylists):
+            playlistsItems.extend(page['items'])
 
+        snapshots = storage.getPlaylistSnapshots([p['id'] for p in playlistsItems]) if storage is not None else {}
+        changed = []
         for playlist in playlistsItems:
-            totalItems = self.enqueue_and_wait(
-                self.userid, self.api.getPlaylistItems, args=(playlist['id'],))['total']
-            y, rest = divmod(totalItems, 50)
-            for j in range(y):
-                playlistComponents = self.enqueue_and_wait(self.userid, self.api.getPlaylistItems, args=(
-                    playlist['id'],), kwargs={"limit": 50, "offset": j*50})
-                items = playlistComponents['items']
-                for item in items:
-                    if item['track'] is not None:
-                        trackids.append(item['track']['id'])
-            if rest != 0:
-                allSongs = self.enqueue_and_wait(self.userid, self.api.getPlaylistItems, args=(
-                    playlist['id'],), kwargs={"limit": 50, "offset": y*50})
-                items = allSongs['items']
-                for item in items:
-                    if item['track'] is not None:
-                        trackids.append(item['track']['id'])
-
-        self.track_IDs.update(trackids)
-        print("finished extracting all playlist tracks")
-
-    def getRecentlyPlayed(self):
-        """ gets all recently played tracks """
-        now = int(datetime.datetime.timestamp(datetime.datetime.now()) * 1000)
-        res = self.enqueue_and_wait(self.userid, self.api.getRecentlyPlayed, kwargs={
-                                    "before": now, "limit": 5})
-        trackids = []
-
-        # self.store(res, 'recentlyPlayed')
-        timestamp = res['cursors']['before']
-        flag = True
-        while flag:
-            res = self.enqueue_and_wait(
-                self.userid, self.api.getRecentlyPlayed, kwargs={"before": timestamp})
-            for item in res['items']:
-                trackids.append(item['track']['id'])
-
-            # self.store(res, 'recentlyPlayed')
-            try:  # when there are no more tracks in history API returns None as cursors
-                timestamp = res['cursors']['after']
-            except TypeError:
-                flag = False
-        self.track_IDs.update(trackids)
+            snapshot = snapshots.get(playlist['id'])
+            if snapshot is not None and snapshot[0] == playlist.get('snapshot_id'):
+                trackids.extend(snapshot[1])
+            else:
+                changed.append(playlist)
+
+        # the playlist objects already carry their track count, so every page of every playlist goes out at once
+        pending = []
+        for playlist in changed:
+            totalItems = (playlist.get('tracks') or {}).get('total')
+            if totalItems is None:
+                totalItems = self.fetch(self.api.getPlaylistItems, playlist['id'], limit=1).result()['total']
+            pending.append((playlist, [self.fetch(self.api.getPlaylistItems, playlist['id'], limit=50, offset=offset)
+                                       for offset in range(0, totalItems, 50)]))
+
+        for playlist, futures in pending:
+            playlistIds = [item['track']['id'] for future in futures for item in future.result()['items']
+                           if item['track'] is not None and item['track'].get('id') is not None]
+            trackids.extend(playlistIds)
+            if storage is not None and playlist.get('snapshot_id'):
+                storage.savePlaylistSnapshot(playlist['id'], playlist['snapshot_id'], playlistIds)
+
+        self.collect(trackids)
+        if storage is not None:
+            storage.saveYankCheckpoint(self.userid, 'playlists', trackids, done=True)
+        print(f"finished extracting all playlist tracks, paged {len(changed)} of {len(playlistsItems)} playlists")
+
+    def getRecentlyPlayed(self, storage: Storage = None, since=None):
+        """
+        gets all recently played tracks, walking the history backwards with the before cursor of every page.
+        since: after cursor of the last sync, then only the plays after it are fetched, walking forwards.
+        With storage the cursor is checkpointed after every page.
+        """
+        if since is not None:
+            return self.getRecentlyPlayedSince(storage, since)
+
+        before = int(datetime.datetime.timestamp(datetime.datetime.now()) * 1000)
+        first = True  # only the newest page carries the mark, a resumed walk already saved it
+        if storage is not None:
+            _, cursor, done = storage.getYankCheckpoint(self.userid, 'recently_played')
+            if done:
+                return
+            if cursor is not None:
+                before = int(cursor)
+                first = False
+
+        while before is not None:
+            res = self.fetch(self.api.getRecentlyPlayed, before=before).result()
+            trackids = [item['track']['id'] for item in res['items']]
+            self.collect(trackids)
+            cursors = res.get('cursors') or {}
+            mark = cursors.get('after') if first else None  # the newest play, where the next delta sync starts
+            first = False
+            # when there are no more tracks in history API returns None as cursors
+            before = cursors.get('before') if trackids else None
+            if storage is not None:
+                storage.saveYankCheckpoint(self.userid, 'recently_played', trackids, cursor=before, done=before is None,
+                                           high_water=mark)
         print("finished extracting all recently played tracks")
 
+    def getRecentlyPlayedSince(self, storage: Storage, since):
+        after = since
+        if storage is not None:
+            _, cursor, done = storage.getYankCheckpoint(self.userid, 'recently_played')
+            if done:
+                return
+            after = cursor or since
+
+        while True:
+            res = self.fetch(self.api.getRecentlyPlayed, after=after).result()
+            trackids = [item['track']['id'] for item in res['items']]
+            self.collect(trackids)
+            newer = (res.get('cursors') or {}).get('after') if trackids else None
+            after = newer or after
+            if storage is not None:
+                storage.saveYankCheckpoint(self.userid, 'recently_played', trackids, cursor=after, done=newer is None,
+                                           high_water=after)
+            if newer is None:
+                break
+        print(f"finished extracting tracks played since {since}")
+
     def getFollowedArtists(self):
-        """ gets all followed artists """
+        """ gets all followed artists, each page is addressed by the last artist id of the previous one """
         followedArtists = []
-        res = self.enqueue_and_wait(self.userid, self.api.getFollowedArtists)
-        for item in res['artists']['items']:
-            followedArtists.append(item['id'])
-        # self.store(self, res, 'followedArtist')
-
-        try:
-            cursor = res['artists']['cursors']['after']
-        except ValueError:
-            cursor = None
-        while cursor is not None:
-            res = self.enqueue_and_wait(self.userid, self.api.getFollowedArtists, kwargs={
-                                        "type": "artist", "after": cursor})
-            # self.store(self, res, 'followedArtist')
-            for item in res['artists']['items']:
-                followedArtists.append(item['id'])
-            try:
-                cursor = res['artists']['cursors']['after']
-            except ValueError:
-                cursor = None
+        cursor = None
+        while True:
+            res = self.fetch(self.api.getFollowedArtists, after=cursor).result()['artists']
+            followedArtists.extend(item['id'] for item in res['items'])
+            # the last page has no after cursor, or no cursors at all
+            cursor = (res.get('cursors') or {}).get('after')
+            if cursor is None or not res['items']:
+                break
         self.artists.update(followedArtists)
 
     def getUserQueue(self):
@@ -215,54 +318,121 @@ class dataYanker:
             trackids.append(currentlyPlaying['id'])
         else:
             return
-        self.track_IDs.update(trackids)
+        self.collect(trackids)
 
-    def getArtistTop(self, time_range='short_term', what='artists'):
-        self.getFollowedArtists()
-        total = self.enqueue_and_wait(self.userid, self.api.getUserTop, kwargs={
-                                      "requestType": what, "timeRange": time_range})["total"]
+    def getArtistTop(self, time_range='short_term', what='artists', storage: Storage = None):
+        """ top tracks of the user's followed and top artists """
+        if storage is not None and storage.getYankCheckpoint(self.userid, 'artists')[2]:
+            return
         trackids = []
         topArtists = []
 
-        x, rest = divmod(total, 50)
-        for i in range(x):
-            items = self.enqueue_and_wait(self.userid, self.api.getUserTop, kwargs={
-                                          "requestType": what, "timeRange": time_range, "offset": i*50})["items"]
-            for item in items:
-                topArtists.append(item['id'])
-
-        if rest != 0:
-            items = self.enqueue_and_wait(self.userid, self.api.getUserTop, kwargs={
-                                          "requestType": what, "timeRange": time_range, "offset": x*50})["items"]
-            for item in items:
+        # the top artists go out while the followed artists are walked
+        topPages = self.iterPages(self.api.getUserTop, requestType=what, timeRange=time_range)
+        firstTop = next(topPages)
+        self.getFollowedArtists()
+        for _, page in [firstTop, *topPages]:
+            for item in page["items"]:
                 topArtists.append(item['id'])
 
         self.artists.update(topArtists)
 
-        for artist in self.artists:
-            tracks = self.enqueue_and_wait(
-                self.userid, self.api.getArtistTop, args=(artist,))['tracks']
-            for track in tracks:
+        futures = [self.fetch(self.api.getArtistTop, artist) for artist in self.artists]
+        for future in futures:
+            for track in future.result()['tracks']:
                 trackids.append(track['id'])
 
-        self.track_IDs.update(trackids)
+        self.collect(trackids)
+        if storage is not None:
+            storage.saveYankCheckpoint(self.userid, 'artists', trackids, done=True)
 
         print("finished extracting ", len(trackids), " artists top tracks")
         print("The user has ", len(topArtists), ' top artists')
 
-    def store_track_ids(self, storage: Storage, limit=750):
+    def store_track_ids(self, storage: Storage, limit=750, batch_size=100):
+        """
+        Fetches the audio analysis of every track not yet in storage and links all tracks to the user,
+        writes go through the bulk apis so a whole library costs a handful of transactions.
+        """
         if limit is None:
             limit = len(self.track_IDs)
+        trackids = list(self.track_IDs)[:limit]
 
-        nTracks = 0
-        for trackid in list(self.track_IDs)[:limit]:
-            if not storage.bTrackExits(trackid):
-                track_data = self.enqueue_and_wait(
-                    self.userid, self.api.getTrackAudioAnalysis, args=(trackid,))
-                storage.addTrackSafe(trackid, track_data=orjson.dumps(
-                    track_data).decode('utf-8'), track_tensor="faketensor")
-                nTracks += 1
+        # plan every audio-analysis fetch up front instead of checking track by track
+        missing = storage.missingTracks(trackids)
+        print(f"{len(missing)} of {len(trackids)} tracks need their audio analysis")
+
+        def analyses():
+            # shared with any other yank fetching the same track right now
+            futures = [(trackid, self.api.enqueue_shared_request(self.userid, self.api.getTrackAudioAnalysis, (trackid,)))
+                       for trackid in missing]
+            for trackid, future in futures:
+                try:
+                    yield trackid, future.result()
+                except Exception as e:
+                    print(f"Could not get audio analysis of {trackid}: {e}")
+
+        self.storeAnalyses(storage, trackids, analyses(), batch_size)
 
-            storage.addUserTrackSafe(self.userid, trackid, None)
+    def storeAnalyses(self, storage: Storage, trackids, analyses, batch_size=100):
+        """
+        Writes fetched audio analyses in bulk as they arrive, feeds them to the scaler and links trackids to the user.
+        analyses: iterable of (trackid, decoded audio analysis)
+        The scaler is only kept up to date once it exists, nothing fits it at ingest while scaling is off
+        (Storage.getSegmentScaler covers every track stored before). Checked before storing anything,
+        so tracks a concurrent first fit already counted are never merged again.
+        """
+        nTracks = 0
+        pending = []
+        # statistics of the new tracks only, merged into the stored scaler
+        scaler = SegmentScaler() if storage.getScalerState(SegmentScaler.NAME) is not None else None
+        for trackid, track_data in analyses:
+            row = encodeTrack(trackid, track_data)
+            if scaler is not None and row[3] is not None:
+                scaler.partial_fit(decodeArray(row[3]))
+            pending.append(row)
+            if len(pending) >= batch_size:
+                nTracks += storage.addTracksBulk(pending, batch_size=batch_size)
+                pending = []
+        nTracks += storage.addTracksBulk(pending, batch_size=batch_size)
+        if scaler is not None and scaler.count:
+            scaler.commit(storage)
+
+        storage.addUserTracksBulk(((self.userid, trackid, None) for trackid in trackids), batch_size=batch_size * 5)
 
         print(f"Stored {nTracks} Tracks")
+
+
+# user ids whose yank thread is running in this process
+_running = set()
+_running_lock = threading.Lock()
+
+
+def startYank(yanker: dataYanker, storage: Storage) -> bool:
+    """
+    Runs yanker.yank in a thread, unless a yank of the same user is already running.
+    Returns whether a yank was started.
+    """
+    with _running_lock:
+        if yanker.userid in _running:
+            return False
+        _running.add(yanker.userid)
+
+    def run():
+        try:
+            yanker.yank(storage)
+        except Exception as e:
+            print(f"yank of user {yanker.userid} failed: {e}")
+        finally:
+            with _running_lock:
+                _running.discard(yanker.userid)
+
+    threading.Thread(target=run).start()
+    return True
+
+
+def resumeYanks(storage: Storage):
+    """ Restarts every yank the previous process left unfinished, with the refresh token stored in its job """
+    for user_id, refresh_token in storage.unfinishedYankJobs():
+        if refresh_token is not None and startYank(dataYanker(None, user_id, refresh_token), storage):
+            print(f"resumed yank of user {user_id}")
@@ -0,0 +1,75 @@
+from typing import List, Tuple, Union
+from pathlib import Path
+import struct
+import numpy as np
+
+
+# Ragged per-user dataset file ({userid}_dataset.scds):
+#   header | int64 offsets (n_tracks + 1) | float32 values (total_segments, emb)
+# track i is values[offsets[i]:offsets[i + 1]], nothing is padded.
+MAGIC = b'SCDS'
+VERSION = 1
+_HEADER = struct.Struct('<4sIIIQ')  # magic, version, n_tracks, emb, values byte offset
+
+
+def writeRaggedDataset(path: Union[str, Path], arrays: List[np.ndarray]) -> int:
+    """
+    Writes the (n_segments, emb) arrays back to back as float32.
+    Returns the number of bytes written.
+    """
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    offsets = np.zeros(len(arrays) + 1, dtype='<i8')
+    np.cumsum(lengths, out=offsets[1:])
+    emb = arrays[0].shape[1] if arrays else 0
+    values_offset = _HEADER.size + offsets.nbytes
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(arrays), emb, values_offset))
+        offsets.tofile(f)
+        for array in arrays:
+            np.ascontiguousarray(array, dtype='<f4').tofile(f)
+    return values_offset + int(offsets[-1]) * emb * 4
+
+
+def writePaddedDataset(path: Union[str, Path], arrays: List[np.ndarray], pad_size: int) -> Tuple[int, int, int]:
+    """
+    The layout the frontend reads (with the shape in a separate file): headerless float64 (n_tracks, pad_size, emb),
+    segments past pad_size cut and the rest zero padded. Written track by track, the padded array is never built.
+    Returns its shape.
+    """
+    emb = arrays[0].shape[1] if arrays else 0
+    padding = np.zeros((pad_size, emb), dtype=np.float64)
+    with open(path, 'wb') as f:
+        for array in arrays:
+            n = min(len(array), pad_size)
+            np.ascontiguousarray(array[:n], dtype=np.float64).tofile(f)
+            padding[n:].tofile(f)
+    return len(arrays), pad_size, emb
+
+
+class RaggedDataset:
+    """
+    Memory-mapped reader for files written by writeRaggedDataset, only touched tracks are paged in.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            magic, version, n_tracks, emb, values_offset = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a ragged dataset")
+        self.version = version
+        self.emb = emb
+        self.offsets = np.memmap(self.path, dtype='<i8', mode='r', offset=_HEADER.size, shape=(n_tracks + 1,))
+        total = int(self.offsets[-1])
+        self.values = np.memmap(self.path, dtype='<f4', mode='r', offset=values_offset, shape=(total, emb)) \
+            if total else np.zeros((0, emb), dtype='<f4')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i) -> np.ndarray:
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
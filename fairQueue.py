@@ -0,0 +1,91 @@
+from typing import Dict
+from collections import OrderedDict, deque
+from queue import Empty
+import threading
+import time
+
+INTERACTIVE = 'interactive'  # page renders, a user is waiting on them
+BACKGROUND = 'background'  # yanks / bulk ingest
+
+
+class FairQueue:
+    """
+    Drop-in for queue.Queue with priority lanes.
+    Lanes are served strictly in order (an interactive request never waits behind background work),
+    inside a lane users take turns in weighted round-robin so one big library cannot starve the others.
+    """
+    def __init__(self, lanes=(INTERACTIVE, BACKGROUND), default_weight: int = 1):
+        """
+        lanes: lane names, highest priority first
+        default_weight: requests a user gets served per turn unless set with setWeight
+        """
+        self.lanes = list(lanes)
+        self.default_weight = default_weight
+        self._users = {lane: OrderedDict() for lane in self.lanes}  # lane -> user_id -> deque of items, in turn order
+        self._served = {lane: 0 for lane in self.lanes}  # items the user at the head of the lane got this turn
+        self._weights: Dict[str, int] = {}
+        self._depth = {lane: 0 for lane in self.lanes}
+        self._cond = threading.Condition()
+        self._all_done = threading.Condition(self._cond)
+        self._unfinished = 0
+
+    def setWeight(self, user_id, weight: int):
+        with self._cond:
+            self._weights[user_id] = max(1, int(weight))
+
+    def put(self, item, user_id=None, lane=BACKGROUND):
+        with self._cond:
+            self._users[lane].setdefault(user_id, deque()).append(item)
+            self._depth[lane] += 1
+            self._unfinished += 1
+            self._cond.notify()
+
+    def _pop(self):
+        for lane in self.lanes:
+            users = self._users[lane]
+            if not users:
+                continue
+            user_id, items = next(iter(users.items()))
+            item = items.popleft()
+            self._depth[lane] -= 1
+            self._served[lane] += 1
+            if not items:
+                del users[user_id]
+                self._served[lane] = 0
+            elif self._served[lane] >= self._weights.get(user_id, self.default_weight):
+                users.move_to_end(user_id)  # next user's turn
+                self._served[lane] = 0
+            return item
+        raise Empty
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                try:
+                    return self._pop()
+                except Empty:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise
+                    self._cond.wait(remaining)
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self):
+        with self._cond:
+            while self._unfinished > 0:
+                self._all_done.wait()
+
+    def depth(self, lane=None):
+        """ Queued requests of one lane, or {lane: depth} for all of them """
+        with self._cond:
+            return self._depth[lane] if lane is not None else dict(self._depth)
+
+    def empty(self):
+        with self._cond:
+            return not any(self._depth.values())
@@ -0,0 +1,133 @@
+from typing import Dict
+from collections import deque
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Connection setup times of the request currently running in this thread, filled by the timed connections
+_conn_timing = threading.local()
+
+
+class _TimedConnectionMixin:
+    """ Records TCP connect and TLS handshake time whenever urllib3 opens a new connection """
+    def _new_conn(self):
+        t0 = time.perf_counter()
+        sock = super()._new_conn()
+        _conn_timing.connect = getattr(_conn_timing, 'connect', 0.0) + time.perf_counter() - t0
+        return sock
+
+    def connect(self):
+        t0 = time.perf_counter()
+        connect_before = getattr(_conn_timing, 'connect', 0.0)
+        super().connect()
+        # whatever connect() took besides the TCP part is the TLS handshake (0 for plain http)
+        total = time.perf_counter() - t0
+        _conn_timing.tls = getattr(_conn_timing, 'tls', 0.0) + total - (getattr(_conn_timing, 'connect', 0.0) - connect_before)
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+class SessionPool:
+    """
+    Process wide keep-alive connection pool shared by every SpotifyAPI instance and SpotiAPIQueue worker.
+    Each thread gets its own requests.Session, all of them mount the same adapter so the underlying
+    connections (and their TLS sessions) are reused across threads.
+    Every response gets a .timings dict (seconds): connect, tls, ttfb, transfer, total.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_instance(**kwargs):
+        """ kwargs configure the pool the first time it is created """
+        if SessionPool._instance is None:
+            with SessionPool._lock:
+                if SessionPool._instance is None:
+                    SessionPool._instance = SessionPool(**kwargs)
+        return SessionPool._instance
+
+    def __init__(self, pool_size: int = 32, timeout=(3.05, 20), history: int = 1000):
+        """
+        pool_size: max keep-alive connections per host
+        timeout: (connect, read) timeout of every request
+        history: number of recent request timings kept for stats()
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.adapter = _TimedHTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.timings = deque(maxlen=history)
+        self._local = threading.local()
+
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            self._local.session = session
+        return session
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        _conn_timing.connect = 0.0
+        _conn_timing.tls = 0.0
+        t0 = time.perf_counter()
+        response = self.session().request(method, url, **kwargs)
+        total = time.perf_counter() - t0
+
+        ttfb = response.elapsed.total_seconds()  # until the headers were parsed, connection setup included
+        response.timings = {
+            'connect': _conn_timing.connect,
+            'tls': _conn_timing.tls,
+            'ttfb': ttfb,
+            'transfer': max(total - ttfb, 0.0),  # body download + gzip decoding
+            'total': total,
+        }
+        self.timings.append(response.timings)
+        return response
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Mean timings (ms) over the recent requests and how many of them had to open a new connection.
+        """
+        timings = list(self.timings)
+        if not timings:
+            return {'requests': 0}
+        stats = {f'{key}_ms': sum(t[key] for t in timings) * 1000 / len(timings)
+                 for key in ('connect', 'tls', 'ttfb', 'transfer', 'total')}
+        stats['requests'] = len(timings)
+        stats['new_connections'] = sum(1 for t in timings if t['connect'] > 0)
+        return stats
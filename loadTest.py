@@ -0,0 +1,136 @@
+"""
+End-to-end ingest load test against mockSpotify: N simulated users go concurrently through
+yank -> store_track_ids -> create_user_dataset, as they would after logging in.
+
+    python -m spoticolor.loadTest --users 20 --latency 0.05 --p429 0.01
+    python -m spoticolor.loadTest --users 20 --async --max-in-flight 64
+
+Without --api-url an in-process mock server is started. The db defaults to a fresh loadtest.db,
+the datasets are written where the app writes them (spoticolor/static/datasets).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import time
+import numpy as np
+import requests
+
+
+def run(args):
+    server = None
+    mock = None
+    if args.api_url is None:
+        from spoticolor.mockSpotify import MockSpotify, MockConfig
+        mock = MockSpotify(MockConfig(latency=args.latency, jitter=args.jitter, p401=args.p401, p429=args.p429,
+                                      retry_after=args.retry_after, catalog_size=args.catalog_size,
+                                      saved_tracks=args.saved_tracks))
+        server = mock.serve(port=args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+    else:
+        base_url = args.api_url.rstrip('/')
+        requests.post(base_url + '/mock/reset')
+    # read by SpotifyAPI, AuthHandler/refresh_grant and Storage when they are created
+    os.environ['SPOTICOLOR_API_URL'] = base_url + '/v1/'
+    os.environ['SPOTICOLOR_ACCOUNTS_URL'] = base_url
+    os.environ['SPOTICOLOR_DB'] = args.db
+    os.environ['SPOTICOLOR_ASYNC_INGEST'] = '1' if args.use_async else '0'
+
+    from spoticolor.rateLimiter import AdaptiveRateLimiter
+    from spoticolor.SpotiAPIQueue import SpotiAPIQueue
+    from spoticolor.storage import Storage
+    from spoticolor.dataYanker import dataYanker
+    from spoticolor.singleFlight import SingleFlight
+    from spoticolor.responseCache import ResponseCache
+    from spoticolor.tokenManager import TokenManager
+    from spoticolor.httpPool import SessionPool
+
+    # configure the shared singletons before the first SpotifyAPI creates them with defaults
+    AdaptiveRateLimiter.get_instance(rate=args.rate, burst=max(1, int(args.rate)), max_rate=args.max_rate)
+    SpotiAPIQueue.get_instance(num_workers=args.workers)
+    if args.use_async:
+        from spoticolor.asyncApi import AsyncSession
+        AsyncSession.get_instance(max_in_flight=args.max_in_flight)
+
+    if args.fresh_db:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    storage = Storage()
+    storage.createTables()
+    os.makedirs('spoticolor/static/datasets', exist_ok=True)
+
+    def yank(i):
+        userid = f"loaduser{i}"
+        yanker = dataYanker(None, userid, f"mock-refresh-{userid}")
+        t0 = time.perf_counter()
+        try:
+            yanker.yank(storage)
+            return userid, time.perf_counter() - t0, None
+        except Exception as e:
+            return userid, time.perf_counter() - t0, e
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        results = list(pool.map(yank, range(args.users)))
+    wall = time.perf_counter() - t0
+
+    stats = mock.stats() if mock is not None else requests.get(base_url + '/mock/stats').json()
+    durations = np.array([duration for _, duration, error in results if error is None])
+    failed = [(userid, error) for userid, _, error in results if error is not None]
+    calls = np.array([stats['users'].get(userid, {}).get('calls', 0) for userid, _, _ in results])
+    with storage.conn as conn:
+        nTracks = conn.execute("SELECT COUNT(*) FROM tracks WHERE status = 'ok'").fetchone()[0]
+
+    print()
+    print(f"users:               {args.users} ({len(failed)} failed)")
+    print("client:              " + (f"async, {args.max_in_flight} in flight" if args.use_async else f"queue, {args.workers} workers"))
+    print(f"wall time:           {wall:.1f} s")
+    print(f"throughput:          {len(durations) / wall * 60:.1f} users/min, {stats['total'] / wall:.1f} API calls/s")
+    if len(durations):
+        print(f"time-to-dataset:     p50 {np.percentile(durations, 50):.1f} s, p99 {np.percentile(durations, 99):.1f} s, "
+              f"max {durations.max():.1f} s")
+    print(f"API calls per user:  mean {calls.mean():.0f}, max {calls.max()}, total {stats['total']}")
+    print(f"status codes:        {stats['statuses']}")
+    print(f"tracks stored:       {nTracks}")
+    print(f"shared in-flight:    {SingleFlight.get_instance().shared}")
+    print(f"response cache:      {ResponseCache.get_instance().stats}")
+    print(f"token refreshes:     {TokenManager.get_instance().refreshes}")
+    print(f"rate limiter:        {AdaptiveRateLimiter.get_instance().rate:.1f} req/s")
+    if not args.use_async:  # aiohttp requests don't go through the SessionPool
+        print(f"http:                {SessionPool.get_instance().stats()}")
+    for userid, error in failed:
+        print(f"  {userid} failed: {error!r}")
+
+    SpotiAPIQueue.reset_instance()
+    if args.use_async:
+        AsyncSession.get_instance().close()
+    if server is not None:
+        server.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent ingest load test against the mock Spotify server")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--api-url', default=None, help="base url of a running mockSpotify, default starts one in-process")
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--db', default='loadtest.db')
+    parser.add_argument('--keep-db', dest='fresh_db', action='store_false', help="reuse the analyses of a previous run")
+    parser.add_argument('--workers', type=int, default=16, help="SpotiAPIQueue workers")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="yank through the asyncio client")
+    parser.add_argument('--max-in-flight', type=int, default=64, help="requests in flight with --async")
+    parser.add_argument('--rate', type=float, default=50.0, help="starting requests per second")
+    parser.add_argument('--max-rate', type=float, default=200.0)
+    # in-process mock server only
+    parser.add_argument('--latency', type=float, default=0.03)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--p401', type=float, default=0.0)
+    parser.add_argument('--p429', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--catalog-size', type=int, default=20000)
+    parser.add_argument('--saved-tracks', type=int, default=400)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+In-process metrics in the Prometheus text format, served by app.py on /metrics.
+Recording is a dict lookup and an add under a per-metric lock, cheap enough for every API request.
+"""
+from typing import Callable, Dict, Iterable, Tuple
+from bisect import bisect_left
+import threading
+import time
+
+# latency buckets in seconds, covering a cached hit up to a throttled retry
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labelText(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        """ [(suffix, label values, extra label text, value)] """
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for suffix, values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_labelText(self.labels, values, extra)} {_number(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [('', key, '', value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class CallbackGauge(_Metric):
+    """ Gauge (or counter) read at scrape time, func returns a number or {label value tuple: number} """
+    def __init__(self, name, help, labels=(), func: Callable = None, type: str = 'gauge'):
+        super().__init__(name, help, labels)
+        self.TYPE = type
+        self.func = func
+
+    def samples(self):
+        if self.func is None:
+            return []
+        values = self.func()
+        if not isinstance(values, dict):
+            return [('', (), '', values)]
+        return [('', key if isinstance(key, tuple) else (key,), '', value) for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple, list] = {}  # label values: [count per bucket..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """ with histogram.time(endpoint='me'): ... """
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, f'le="{_number(bound)}"', cumulative))
+            samples.append(('_count', key, '', cumulative))
+            samples.append(('_sum', key, '', counts[-1]))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.t0, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        self.metrics[metric.name] = metric
+
+    def expose(self) -> str:
+        return '\n'.join(metric.expose() for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def expose() -> str:
+    return REGISTRY.expose()
+
+
+# Path segments that follow these are ids, endpointLabel replaces them so label values stay bounded
+_ID_PARENTS = {'audio-analysis', 'audio-features', 'playlists', 'artists', 'tracks', 'albums', 'users', 'categories'}
+
+
+def endpointLabel(endpoint: str) -> str:
+    """ 'playlists/37i9dQZF1DX/tracks' -> 'playlists/{id}/tracks' """
+    parts = endpoint.strip('/').split('/')
+    return '/'.join('{id}' if i and parts[i - 1] in _ID_PARENTS else part for i, part in enumerate(parts))
+
+
+# ---- Spotify API ----
+API_LATENCY = Histogram('spoticolor_api_request_seconds', "Spotify API request latency", ['endpoint'])
+API_RESPONSES = Counter('spoticolor_api_responses_total', "Spotify API responses by status code", ['endpoint', 'status'])
+TOKEN_REFRESHES = Counter('spoticolor_token_refreshes_total', "Access token refreshes", ['result'])
+
+# ---- SpotiAPIQueue ----
+QUEUE_ENQUEUED = Counter('spoticolor_queue_enqueued_total', "Requests enqueued", ['lane'])
+QUEUE_WAIT = Histogram('spoticolor_queue_wait_seconds', "Time from enqueue until a worker starts the request", ['lane'])
+QUEUE_THROTTLED = Counter('spoticolor_queue_throttled_total', "Requests re-enqueued after a 429")
+QUEUE_ERRORS = Counter('spoticolor_queue_errors_total', "Requests that failed for good", ['lane'])
+WORKER_BUSY = Gauge('spoticolor_queue_workers_busy', "Workers running a request")
+WORKER_BUSY_SECONDS = Counter('spoticolor_queue_worker_busy_seconds_total',
+                              "Seconds workers spent running requests, divide by workers * uptime for utilization")
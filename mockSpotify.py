@@ -0,0 +1,446 @@
+"""
+Local stand-in for the Spotify Web API and accounts service, so the ingest pipeline can be load tested
+without spending real quota. Payloads are synthetic but deterministic and realistically sized.
+
+    python -m spoticolor.mockSpotify --port 8900 --latency 0.05 --p429 0.01
+
+and point the app at it with
+    SPOTICOLOR_API_URL=http://localhost:8900/v1/ SPOTICOLOR_ACCOUNTS_URL=http://localhost:8900
+
+Any refresh token is accepted, "mock-refresh-<user>" logs in as <user>. Access tokens expire after
+token_ttl and are forgotten on restart, like real ones. GET /mock/stats has the calls made per user.
+"""
+from typing import Dict, List, Optional
+from collections import defaultdict
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import random
+import sys
+import threading
+import time
+from flask import Flask, Response, request, jsonify
+
+
+class MockConfig:
+    def __init__(self, latency: float = 0.03, jitter: float = 0.02, p401: float = 0.0, p429: float = 0.0,
+                 retry_after: int = 1, token_ttl: int = 3600, catalog_size: int = 20000, saved_tracks: int = 400,
+                 top_tracks: int = 50, recently_played: int = 50, playlists: int = 10, playlist_size: int = 60,
+                 followed_artists: int = 30, segments_per_second: float = 3.5, seed: int = 0):
+        """
+        latency / jitter: seconds every request takes, uniform in [latency, latency + jitter]
+        p401 / p429: chance a request fails with an expired token / rate limit (429 carries Retry-After: retry_after)
+        catalog_size: tracks every library is drawn from, popular ones are shared by many users
+        saved_tracks, top_tracks, recently_played, playlists, playlist_size, followed_artists: mean sizes per user (+-50%)
+        segments_per_second: audio analysis segments, ~3.5 like real analyses
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.p401 = p401
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.catalog_size = catalog_size
+        self.saved_tracks = saved_tracks
+        self.top_tracks = top_tracks
+        self.recently_played = recently_played
+        self.playlists = playlists
+        self.playlist_size = playlist_size
+        self.followed_artists = followed_artists
+        self.segments_per_second = segments_per_second
+        self.seed = seed
+
+
+def _rng(*key) -> random.Random:
+    return random.Random(hashlib.sha1(repr(key).encode()).hexdigest())
+
+
+def trackId(n: int) -> str:
+    return f"mock{n:018d}"
+
+
+def artistId(n: int) -> str:
+    return f"mockartist{n:012d}"
+
+
+def _iso(ms: int) -> str:
+    return datetime.datetime.utcfromtimestamp(ms / 1000).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class MockLibrary:
+    """ Deterministic synthetic data, the same user always gets the same library """
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.epoch_ms = int(time.time() * 1000)
+
+    def _size(self, user, what, mean):
+        return max(1, int(mean * _rng(self.config.seed, user, what).uniform(0.5, 1.5)))
+
+    def _pick(self, rng, n) -> List[int]:
+        """ n distinct catalog tracks, skewed towards the popular (low) ids """
+        picked = []
+        seen = set()
+        while len(picked) < min(n, self.config.catalog_size):
+            track = int(self.config.catalog_size * rng.random() ** 2)
+            if track not in seen:
+                seen.add(track)
+                picked.append(track)
+        return picked
+
+    def track(self, n: int) -> Dict:
+        artist = n % max(1, self.config.catalog_size // 8)
+        return {
+            'id': trackId(n),
+            'name': f"Mock track {n}",
+            'type': 'track',
+            'duration_ms': int(_rng('duration', n).uniform(120, 300) * 1000),
+            'artists': [{'id': artistId(artist), 'name': f"Mock artist {artist}", 'type': 'artist'}],
+            'album': {'id': f"mockalbum{n // 12:013d}", 'name': f"Mock album {n // 12}",
+                      'images': [{'url': f"https://i.scdn.co/image/mock{n // 12}", 'height': 640, 'width': 640}]},
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{trackId(n)}"},
+            'popularity': max(0, 100 - n * 100 // self.config.catalog_size),
+        }
+
+    def saved(self, user) -> List[int]:
+        return self._pick(_rng(self.config.seed, user, 'saved'), self._size(user, 'saved', self.config.saved_tracks))
+
+    def top(self, user, what) -> List[int]:
+        tracks = self._pick(_rng(self.config.seed, user, 'top'), self._size(user, 'top', self.config.top_tracks))
+        if what == 'artists':
+            return list(dict.fromkeys(n % max(1, self.config.catalog_size // 8) for n in tracks))
+        return tracks
+
+    def history(self, user) -> List[tuple]:
+        """ [(played_at ms, track)] newest first """
+        rng = _rng(self.config.seed, user, 'history')
+        tracks = self._pick(rng, self._size(user, 'history', self.config.recently_played))
+        played_at = self.epoch_ms
+        history = []
+        for n in tracks:
+            played_at -= int(rng.uniform(150, 400) * 1000)
+            history.append((played_at, n))
+        return history
+
+    def playlistIds(self, user) -> List[str]:
+        return [f"{user}pl{i}" for i in range(self._size(user, 'playlists', self.config.playlists))]
+
+    def playlist(self, playlist_id) -> List[int]:
+        return self._pick(_rng(self.config.seed, playlist_id), self._size(playlist_id, 'items', self.config.playlist_size))
+
+    def followed(self, user) -> List[int]:
+        rng = _rng(self.config.seed, user, 'followed')
+        n = self._size(user, 'followed', self.config.followed_artists)
+        return sorted({int(self.config.catalog_size // 8 * rng.random() ** 2) for _ in range(n)})
+
+    def artistTop(self, artist: int) -> List[int]:
+        return self._pick(_rng(self.config.seed, 'artist', artist), 10)
+
+
+@lru_cache(maxsize=256)
+def audioAnalysis(track_id: str, segments_per_second: float) -> bytes:
+    """ Serialized synthetic audio analysis, same structure and about the same size as Spotify's """
+    rng = _rng('analysis', track_id)
+    duration = rng.uniform(120, 300)
+    tempo = rng.uniform(70, 170)
+
+    def r(x):
+        return round(x, 5)
+
+    segments = []
+    start = 0.0
+    while start < duration:
+        length = rng.uniform(0.5, 1.5) / segments_per_second
+        loudness = rng.uniform(-40, -5)
+        segments.append({
+            'start': r(start), 'duration': r(length), 'confidence': r(rng.random()),
+            'loudness_start': r(loudness - rng.uniform(0, 10)), 'loudness_max': r(loudness),
+            'loudness_max_time': r(rng.uniform(0, length)), 'loudness_end': 0.0,
+            'pitches': [r(rng.random()) for _ in range(12)],
+            'timbre': [r(rng.gauss(0, 50)) for _ in range(12)],
+        })
+        start += length
+
+    def intervals(step):
+        n = int(duration / step)
+        return [{'start': r(i * step), 'duration': r(step), 'confidence': r(rng.random())} for i in range(n)]
+
+    beat = 60 / tempo
+    analysis = {
+        'meta': {'analyzer_version': '4.0.0', 'platform': 'Linux', 'status_code': 0, 'timestamp': 0},
+        'track': {'duration': r(duration), 'tempo': r(tempo), 'loudness': r(rng.uniform(-20, -3)),
+                  'key': rng.randrange(12), 'mode': rng.randrange(2), 'time_signature': 4,
+                  'num_samples': int(duration * 22050), 'sample_md5': ''},
+        'bars': intervals(beat * 4),
+        'beats': intervals(beat),
+        'sections': intervals(duration / 8),
+        'segments': segments,
+        'tatums': intervals(beat / 2),
+    }
+    return json.dumps(analysis).encode()
+
+
+class MockSpotify:
+    """ The mock server state: issued tokens and call counters """
+    def __init__(self, config: Optional[MockConfig] = None):
+        self.config = config or MockConfig()
+        self.library = MockLibrary(self.config)
+        self.tokens: Dict[str, tuple] = {}  # access token: (user, expires_at)
+        self.calls = defaultdict(lambda: defaultdict(int))  # user: endpoint: count
+        self.statuses = defaultdict(int)
+        self.refreshes = defaultdict(int)
+        self._lock = threading.Lock()
+        self.app = self.createApp()
+
+    # ---- state ----
+    def issueToken(self, user) -> Dict:
+        token = hashlib.sha1(f"{user}{time.time()}{random.random()}".encode()).hexdigest()
+        with self._lock:
+            self.tokens[token] = (user, time.time() + self.config.token_ttl)
+            self.refreshes[user] += 1
+        return {'access_token': token, 'token_type': 'Bearer', 'expires_in': self.config.token_ttl,
+                'scope': '', 'refresh_token': f"mock-refresh-{user}"}
+
+    def userOf(self, header) -> Optional[str]:
+        token = (header or '').replace('Bearer ', '')
+        user, expires_at = self.tokens.get(token, (None, 0))
+        return user if time.time() < expires_at else None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            users = {user: {'calls': sum(endpoints.values()), 'endpoints': dict(endpoints),
+                            'refreshes': self.refreshes.get(user, 0)}
+                     for user, endpoints in self.calls.items()}
+            return {'users': users, 'statuses': dict(self.statuses),
+                    'total': sum(user['calls'] for user in users.values())}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.statuses.clear()
+            self.refreshes.clear()
+
+    # ---- flask ----
+    def createApp(self) -> Flask:
+        app = Flask(__name__)
+        config = self.config
+        library = self.library
+
+        def page(items, total):
+            return {'items': items, 'total': total, 'limit': int(request.args.get('limit', 20)),
+                    'offset': int(request.args.get('offset', 0)), 'next': None, 'previous': None}
+
+        def window(sequence):
+            offset, limit = int(request.args.get('offset', 0)), int(request.args.get('limit', 20))
+            return sequence[offset:offset + limit]
+
+        def respond(status, body=None, headers=None):
+            with self._lock:
+                self.statuses[status] += 1
+            return Response(body, status=status, headers=headers, mimetype='application/json')
+
+        @app.before_request
+        def simulate():
+            if request.path.startswith('/v1/'):
+                time.sleep(config.latency + random.random() * config.jitter)
+
+        @app.route('/api/token', methods=['POST'])
+        def token():
+            if request.form.get('grant_type') == 'refresh_token':
+                refresh_token = request.form.get('refresh_token', '')
+            else:
+                refresh_token = request.form.get('code', '')
+            user = refresh_token.replace('mock-refresh-', '') or 'anonymous'
+            return jsonify(self.issueToken(user))
+
+        @app.route('/mock/stats')
+        def mockStats():
+            return jsonify(self.stats())
+
+        @app.route('/mock/reset', methods=['POST'])
+        def mockReset():
+            self.reset()
+            return jsonify({})
+
+        @app.route('/v1/<path:endpoint>')
+        def api(endpoint):
+            user = self.userOf(request.headers.get('Authorization'))
+            if user is None or random.random() < config.p401:
+                return respond(401, json.dumps({'error': {'status': 401, 'message': 'The access token expired'}}))
+            with self._lock:
+                self.calls[user][endpoint.split('/')[0] if not endpoint.startswith('me') else endpoint] += 1
+            if random.random() < config.p429:
+                return respond(429, json.dumps({'error': {'status': 429, 'message': 'API rate limit exceeded'}}),
+                               {'Retry-After': str(config.retry_after)})
+
+            body = route(user, endpoint)
+            if body is None:
+                return respond(404, json.dumps({'error': {'status': 404, 'message': 'Not found'}}))
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if request.headers.get('If-None-Match') == etag:
+                return respond(304, headers={'ETag': etag})
+            return respond(200, body, {'ETag': etag})
+
+        def route(user, endpoint):
+            parts = endpoint.strip('/').split('/')
+            if parts == ['me']:
+                return {'id': user, 'display_name': f"Mock {user}", 'email': f"{user}@mock.local",
+                        'images': [], 'followers': {'total': 0}, 'country': 'NL', 'product': 'premium'}
+            if parts == ['me', 'tracks']:
+                saved = library.saved(user)
+                added = [library.epoch_ms - i * 86400000 // 3 for i in range(len(saved))]  # newest first
+                return page([{'added_at': _iso(at), 'track': library.track(n)}
+                             for at, n in window(list(zip(added, saved)))], len(saved))
+            if parts[:2] == ['me', 'top'] and len(parts) == 3:
+                items = library.top(user, parts[2])
+                if parts[2] == 'artists':
+                    return page([{'id': artistId(a), 'name': f"Mock artist {a}", 'type': 'artist'}
+                                 for a in window(items)], len(items))
+                return page([library.track(n) for n in window(items)], len(items))
+            if parts == ['me', 'player', 'recently-played']:
+                history = library.history(user)
+                limit = int(request.args.get('limit', 20))
+                if 'after' in request.args:
+                    items = [h for h in history if h[0] > int(request.args['after'])][-limit:]
+                else:
+                    items = [h for h in history if h[0] < int(request.args.get('before', 2**62))][:limit]
+                cursors = {'after': str(items[0][0]), 'before': str(items[-1][0])} if items else None
+                return {'items': [{'played_at': _iso(at), 'track': library.track(n)} for at, n in items],
+                        'cursors': cursors, 'limit': limit, 'next': None}
+            if parts == ['me', 'playlists']:
+                playlists = library.playlistIds(user)
+                return page([{'id': pid, 'name': pid, 'snapshot_id': hashlib.md5(pid.encode()).hexdigest(),
+                              'tracks': {'total': len(library.playlist(pid))}} for pid in window(playlists)],
+                            len(playlists))
+            if parts[0] == 'playlists' and len(parts) == 3 and parts[2] == 'tracks':
+                items = library.playlist(parts[1])
+                return page([{'added_at': _iso(library.epoch_ms), 'track': library.track(n)}
+                             for n in window(items)], len(items))
+            if parts == ['me', 'following']:
+                followed = library.followed(user)
+                after = request.args.get('after')
+                start = followed.index(int(after[len('mockartist'):])) + 1 if after else 0
+                items = followed[start:start + int(request.args.get('limit', 20))]
+                last = start + len(items) < len(followed)
+                return {'artists': {'items': [{'id': artistId(a), 'name': f"Mock artist {a}", 'type': 'artist'}
+                                              for a in items],
+                                    'cursors': {'after': artistId(items[-1]) if items and last else None},
+                                    'total': len(followed)}}
+            if parts[0] == 'artists' and len(parts) == 3 and parts[2] == 'top-tracks':
+                return {'tracks': [library.track(n) for n in library.artistTop(int(parts[1][len('mockartist'):]))]}
+            if parts[0] == 'audio-analysis' and len(parts) == 2:
+                return audioAnalysis(parts[1], config.segments_per_second)
+            if parts[0] == 'tracks':
+                ids = parts[1:] or request.args.get('ids', '').split(',')
+                tracks = [library.track(int(i[4:])) if i.startswith('mock') else None for i in ids]
+                return tracks[0] if len(parts) == 2 else {'tracks': tracks}
+            if parts == ['artists']:
+                ids = request.args.get('ids', '').split(',')
+                return {'artists': [{'id': i, 'name': f"Mock artist {i}", 'type': 'artist'} for i in ids]}
+            if parts == ['audio-features']:
+                ids = request.args.get('ids', '').split(',')
+                return {'audio_features': [{'id': i, **{f: _rng('features', i, f).random() for f in
+                                                        ('danceability', 'energy', 'valence', 'acousticness')}}
+                                           for i in ids]}
+            return None
+
+        return app
+
+    def makeServer(self, host='127.0.0.1', port=8900) -> ThreadingHTTPServer:
+        """
+        HTTP/1.1 server with keep-alive, like the real API, so a load test exercises the client's connection pool.
+        werkzeug's dev server sends Connection: close on every response, which would make every request a new connection.
+        """
+        app = self.app
+
+        class KeepAliveHandler(_WSGIHandler):
+            wsgi_app = app
+
+        server = ThreadingHTTPServer((host, port), KeepAliveHandler)
+        server.daemon_threads = True
+        return server
+
+    def serve(self, host='127.0.0.1', port=8900):
+        """ Runs the server in a daemon thread, returns it (server.shutdown() stops it) """
+        server = self.makeServer(host, port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class _WSGIHandler(BaseHTTPRequestHandler):
+    """ Just enough WSGI to run the mock's Flask app on a persistent connection per client """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are separate writes, don't wait for the delayed ack in between
+    wsgi_app = None
+
+    def do_GET(self):
+        self.runWsgi()
+
+    do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+
+    def runWsgi(self):
+        path, _, query = self.path.partition('?')
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        host, port = self.server.server_address[:2]
+        environ = {
+            'REQUEST_METHOD': self.command, 'SCRIPT_NAME': '', 'PATH_INFO': unquote(path), 'QUERY_STRING': query,
+            'SERVER_NAME': host, 'SERVER_PORT': str(port), 'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''), 'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        for name, value in self.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+
+        started = []
+        result = self.wsgi_app(environ, lambda status, headers, exc_info=None: started.append((status, headers)))
+        try:
+            payload = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers = started[-1]
+        code, _, reason = status.partition(' ')
+        self.send_response(int(code), reason)
+        for name, value in headers:
+            if name.lower() not in ('content-length', 'connection'):
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # no access log line per request
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Spotify Web API for load tests")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.03)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--p401', type=float, default=0.0)
+    parser.add_argument('--p429', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--token-ttl', type=int, default=3600)
+    parser.add_argument('--catalog-size', type=int, default=20000)
+    parser.add_argument('--saved-tracks', type=int, default=400)
+    args = parser.parse_args()
+    config = MockConfig(latency=args.latency, jitter=args.jitter, p401=args.p401, p429=args.p429,
+                        retry_after=args.retry_after, token_ttl=args.token_ttl,
+                        catalog_size=args.catalog_size, saved_tracks=args.saved_tracks)
+    MockSpotify(config).makeServer(args.host, args.port).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
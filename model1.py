@@ -1,6 +1,12 @@
+from itertools import islice
 import numpy as np
 import onnxruntime
 import time
+from spoticolor.dataset import writePaddedDataset, writeRaggedDataset, RaggedDataset
+
+MODEL_PATH = "models/modelunoEm6B32.onnx"
+# Stored in the header of every track tensor, bump when the model changes
+MODEL_VERSION = 1
 
 
 class ModelUno:
@@ -27,66 +33,39 @@ class ModelUno:
 def create_user_dataset(userid, max_tracks=750):
     from spoticolor.storage import Storage
     padSize = 750
-    model = ModelUno("models/modelunoEm6B32.onnx")
+    model = ModelUno(MODEL_PATH)
     store = Storage()
     t1 = time.time()
-    padded_tracks, track_ids = store.preprocess_tracks(None, userid=userid)
-    if len(padded_tracks) > max_tracks:
-        padded_tracks, track_ids = padded_tracks[:max_tracks], track_ids[:max_tracks]
+    # segment matrices are streamed from the db, only the model outputs are kept
+    matrices = (matrix for chunk in store.streamSegmentMatrices(userid=userid) for matrix in chunk)
     tokens = []
-    for track, track_id in zip(padded_tracks, track_ids):
+    for track_id, track in islice(matrices, max_tracks):
         model_output = model(track)
         tokens.append((track_id, model_output))
+    track_ids = [track_id for track_id, _ in tokens]
 
-    for track_id, model_output in tokens:
-        store.updateTrackTensor(track_id, model_output)
-
-    embSize = len(tokens[0][1][1])
-    padded_result = np.full((len(tokens), padSize, embSize), np.nan)
+    store.updateTrackTensors(tokens, model_version=MODEL_VERSION)
 
-    for i, x in enumerate([t[1] for t in tokens]):
-        nSeg = min(x.shape[0], 750)
-        padded_result[i, :nSeg, :] = x[:nSeg]
+    # segments past padSize were never used, keep the cut but drop the padding
+    arrays = [np.nan_to_num(x[:padSize], nan=0.0) for _, x in tokens]
     t2 = time.time()
-    print(padded_result.shape)
-    padded_result = np.nan_to_num(padded_result, nan=0.0)
-
-    min_val = np.nanmin(padded_result, axis=(1, 2), keepdims=True)
-    max_val = np.nanmax(padded_result, axis=(1, 2), keepdims=True)
-
-    range_val = max_val - min_val
-    range_val[range_val == 0] = 1  # Prevent division by zero
-
-    # Perform min-max scaling
-    scaled_array = (padded_result - min_val) / range_val
 
-    # Handle the case where min_val == max_val
-    scaled_array[(max_val == min_val).repeat(padded_result.shape[1], axis=1).repeat(padded_result.shape[2], axis=2)] = 0  # or padded_result[(max_val == min_val).repeat(padded_result.shape[1], axis=1).repeat(padded_result.shape[2], axis=2)]
-    scaled_result = scaled_array
-
-    #for i in range(padded_result.shape[0]):
-    #    for j in range(padded_result.shape[1]):
-    #        item = padded_result[i, j, :]
-    #        min_val = np.nanmin(item)
-    #        max_val = np.nanmax(item)
-    #        if min_val == max_val:
-    #            scaled_array[i, j, :] = 0  # or scaled_array[i, j, :] = item, depending on your needs
-    #        else:
-    #            scaled_array[i, j, :] = (item - min_val) / (max_val - min_val)
-
-    print(f"took {(t2-t1)*1000}ms for {padded_result.shape[0]} tracks")
-
-    padded_result.tofile(f"spoticolor/static/datasets/{userid}_dataset.bin")
+    # the frontend still reads the padded file and its shape, keep writing them until it reads the ragged one
+    shape = writePaddedDataset(f"spoticolor/static/datasets/{userid}_dataset.bin", arrays, padSize)
     with open(f"spoticolor/static/datasets/{userid}_dataset_shape.txt", "w") as f:
-        f.write(str(padded_result.shape))
+        f.write(str(shape))
+
+    dataset_path = f"spoticolor/static/datasets/{userid}_dataset.scds"
+    nBytes = writeRaggedDataset(dataset_path, arrays)
+    print(f"took {(t2-t1)*1000}ms for {len(arrays)} tracks, wrote {nBytes} bytes")
 
     with open(f'spoticolor/static/datasets/{userid}_dataset_trackids.txt', 'w') as f:
         for item in track_ids:
             f.write(f"{item}\n")
-    return padded_result, track_ids
+    return RaggedDataset(dataset_path), track_ids
 
 
 if __name__ == "__main__":
-    array, track_ids = create_user_dataset("31kbrhyfxsw2qcosmsgycku2kxwu")
-    print(array.shape, np.nanmax(array), np.nanmin(array), "\n", array)
-    print(f"Does the data contain NaNs?: {np.isnan(array).any()}")
+    dataset, track_ids = create_user_dataset("31kbrhyfxsw2qcosmsgycku2kxwu")
+    print(len(dataset), dataset.values.shape, np.max(dataset.values), np.min(dataset.values))
+    print(f"Does the data contain NaNs?: {np.isnan(dataset.values).any()}")
@@ -0,0 +1,100 @@
+import threading
+import time
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by all API workers whose rate adapts to what Spotify actually allows (AIMD):
+    every success probes the rate up additively, a 429 halves it and blocks everyone for Retry-After.
+    The rate is cut once per throttle window, the other requests in flight when it hit get 429s for the same window.
+    get_instance() is the budget shared by all SpotiAPIQueue workers and the asyncApi client.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_instance(**kwargs):
+        """ kwargs configure the limiter the first time it is created """
+        if AdaptiveRateLimiter._instance is None:
+            with AdaptiveRateLimiter._lock:
+                if AdaptiveRateLimiter._instance is None:
+                    AdaptiveRateLimiter._instance = AdaptiveRateLimiter(**kwargs)
+        return AdaptiveRateLimiter._instance
+
+    def __init__(self, rate: float = 4.0, burst: int = 2, min_rate: float = 0.5, max_rate: float = None,
+                 increase: float = 0.2, decrease: float = 0.5):
+        """
+        rate: starting budget in requests per second
+        burst: bucket size, requests that may go out back to back
+        max_rate: ceiling the rate probes up to, defaults to twice the starting budget
+        increase: requests per second added per second of successful traffic
+        decrease: factor the rate is multiplied with on a 429
+        """
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate * 2
+        self.increase = increase
+        self.decrease = decrease
+
+        self.tokens = float(burst)
+        self.blocked_until = 0.0
+        self.last_decrease = float('-inf')
+        self.last_refill = time.monotonic()
+        self._bucket_lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token if one is available and returns 0, otherwise returns the seconds to wait before trying again.
+        """
+        with self._bucket_lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """ Blocks until a request may be sent """
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def refund(self):
+        """ Gives back a token that was acquired but not used """
+        with self._bucket_lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def onSuccess(self):
+        with self._bucket_lock:
+            # additive increase, scaled so the rate grows by self.increase per second of traffic
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def onThrottle(self, retry_after=None, sent_at=None):
+        """
+        A 429 came back: back off globally for retry_after seconds (1 if Spotify did not say) and cut the rate.
+        sent_at: time.monotonic() the request went out. 429s of requests sent before the last cut,
+        or arriving while a back off is still active, belong to a window that was already paid for.
+        """
+        try:
+            retry_after = float(retry_after)
+        except (TypeError, ValueError):
+            retry_after = 1.0
+        with self._bucket_lock:
+            now = time.monotonic()
+            seen = now < self.blocked_until or (sent_at is not None and sent_at < self.last_decrease)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            if not seen:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease = now
+            self.tokens = 0.0
+            self.last_refill = max(now, self.blocked_until)
@@ -0,0 +1,264 @@
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+import json
+import re
+import sqlite3
+import threading
+import time
+from spoticolor.singleFlight import SingleFlight
+from spoticolor import metrics
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'expires')
+
+    def __init__(self, body: bytes, etag: Optional[str], expires: float):
+        self.body = body  # raw json, every hit decodes its own copy so callers can't mutate the cache
+        self.etag = etag
+        self.expires = expires
+
+    def fresh(self, now=None) -> bool:
+        return (now or time.time()) < self.expires
+
+
+class ResponseCache:
+    """
+    Response cache in front of SpotifyAPI.makeRequest.
+    Fresh entries are served without touching the network, stale ones are revalidated with If-None-Match
+    so an unchanged resource costs a bodyless 304 instead of a full download.
+    me/* (and playlist) responses are keyed per user, catalog responses are shared between all users.
+    Memory is bounded with LRU eviction, an optional sqlite file keeps entries across restarts.
+    """
+    # (endpoint pattern, ttl in seconds, keyed per user), first match wins, no match is not cached.
+    # audio-analysis is left out on purpose: analyses are stored in the tracks table, and at ~400 KB each
+    # they would flush everything else out of the cache
+    RULES = [
+        (r'me/player/recently-played', 30, True),
+        (r'me/player/.*', 0, True),
+        (r'me/top/.*', 3600, True),
+        (r'me/(tracks|playlists|following)', 300, True),
+        (r'me', 3600, True),
+        (r'playlists/.*', 300, True),
+        (r'audio-features', 7 * 24 * 3600, False),
+        (r'(tracks|artists)(/[^/]+)?', 24 * 3600, False),
+        (r'artists/.*/top-tracks', 24 * 3600, False),
+        (r'(browse/.*|recommendations|search)', 600, False),
+    ]
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_instance(**kwargs):
+        """ kwargs configure the cache the first time it is created """
+        if ResponseCache._instance is None:
+            with ResponseCache._lock:
+                if ResponseCache._instance is None:
+                    ResponseCache._instance = ResponseCache(**kwargs)
+        return ResponseCache._instance
+
+    def __init__(self, max_bytes: int = 64 * 2**20, max_entries: int = 10000, disk_path: Optional[str] = None,
+                 max_disk_entries: int = 100000, max_disk_bytes: int = 512 * 2**20):
+        """
+        max_bytes / max_entries: in memory bound, least recently used entries are evicted first
+        disk_path: sqlite file of the on-disk tier, None keeps the cache in memory only
+        max_disk_entries / max_disk_bytes: on disk bound, the least recently stored rows are pruned
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.rules = [(re.compile(pattern), ttl, per_user) for pattern, ttl, per_user in self.RULES]
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'disk_hits': 0, 'evictions': 0}
+        self._entries_lock = threading.Lock()
+        self.inflight = SingleFlight.get_instance()
+        metrics.CallbackGauge('spoticolor_cache_events_total', "Response cache lookups by outcome", ['event'],
+                              lambda: dict(self.stats), type='counter')
+        metrics.CallbackGauge('spoticolor_cache_bytes', "Bytes held by the in memory response cache", func=lambda: self.size)
+        metrics.CallbackGauge('spoticolor_cache_disk_bytes', "Bytes held by the on disk response cache",
+                              func=lambda: self.disk_size)
+
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.disk = None
+        self.disk_size = 0
+        self._disk_writes = 0
+        if disk_path is not None:
+            self.disk = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self.disk.execute("PRAGMA journal_mode=WAL")
+            self.disk.execute("PRAGMA synchronous=NORMAL")
+            self.disk.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    etag TEXT,
+                    expires REAL NOT NULL,
+                    stored REAL NOT NULL
+                )""")
+            self.disk.execute("CREATE INDEX IF NOT EXISTS idx_responses_stored ON responses (stored)")
+            self.disk_size = self.disk.execute("SELECT COALESCE(SUM(length(body)), 0) FROM responses").fetchone()[0]
+            self._disk_lock = threading.RLock()  # _diskPut prunes while holding it
+            self._diskPrune()
+
+    def rule(self, endpoint: str) -> Optional[Tuple[int, bool]]:
+        """ (ttl, per_user) of endpoint, None if it is not cached """
+        for pattern, ttl, per_user in self.rules:
+            if pattern.fullmatch(endpoint):
+                return (ttl, per_user) if ttl > 0 else None
+        return None
+
+    @staticmethod
+    def key(endpoint: str, params: Optional[Dict], user_key: Optional[str]) -> str:
+        query = '&'.join(f'{k}={v}' for k, v in sorted((params or {}).items()) if v is not None)
+        return f'{user_key or "*"}|{endpoint}?{query}'
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._entries_lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        entry = self._diskGet(key)
+        if entry is not None:
+            self.stats['disk_hits'] += 1
+            self._memPut(key, entry)
+        return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        self._memPut(key, entry)
+        self._diskPut(key, entry)
+
+    def invalidate(self, user_key: str):
+        """ Drops every per-user entry of user_key, e.g. after the user changed their library """
+        prefix = f'{user_key}|'
+        with self._entries_lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                self.size -= len(self.entries.pop(key).body)
+        if self.disk is not None:
+            with self._disk_lock:
+                self.disk.execute("DELETE FROM responses WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+                self.disk_size = self.disk.execute("SELECT COALESCE(SUM(length(body)), 0) FROM responses").fetchone()[0]
+
+    def clear(self):
+        with self._entries_lock:
+            self.entries.clear()
+            self.size = 0
+        if self.disk is not None:
+            with self._disk_lock:
+                self.disk.execute("DELETE FROM responses")
+                self.disk_size = 0
+
+    def request(self, api, endpoint: str, params: Optional[Dict] = None) -> Dict:
+        """
+        Decoded json of GET endpoint for api's user, served from the cache whenever possible.
+        api.fetch does the actual (conditional) request.
+        """
+        rule = self.rule(endpoint)
+        if rule is None:
+            return api.fetch(endpoint, params).json()
+        ttl, per_user = rule
+        key = self.key(endpoint, params, api.user_key if per_user else None)
+
+        entry = self.get(key)
+        if entry is not None and entry.fresh():
+            self.stats['hits'] += 1
+            return json.loads(entry.body)
+
+        self.stats['misses'] += 1
+        if per_user:
+            body = self._load(api, endpoint, params, key, ttl, entry)
+        else:
+            # catalog responses are the same for everyone, concurrent misses of one key share a single request
+            body = self.inflight.call(key, self._load, api, endpoint, params, key, ttl, entry)
+        return json.loads(body)
+
+    async def requestAsync(self, api, endpoint: str, params: Optional[Dict] = None) -> Dict:
+        """
+        request for asyncApi.AsyncSpotifyAPI, whose fetch is a coroutine.
+        Concurrent catalog misses are not merged here, enqueue_shared_request merges them before they are sent.
+        """
+        rule = self.rule(endpoint)
+        if rule is None:
+            return (await api.fetch(endpoint, params)).json()
+        ttl, per_user = rule
+        key = self.key(endpoint, params, api.user_key if per_user else None)
+
+        entry = self.get(key)
+        if entry is not None and entry.fresh():
+            self.stats['hits'] += 1
+            return json.loads(entry.body)
+
+        self.stats['misses'] += 1
+        response = await api.fetch(endpoint, params, etag=entry.etag if entry is not None else None)
+        return json.loads(self._store(key, ttl, entry, response))
+
+    def _load(self, api, endpoint, params, key, ttl, entry) -> bytes:
+        """ (Re)validates key against the API, returns the raw body """
+        response = api.fetch(endpoint, params, etag=entry.etag if entry is not None else None)
+        return self._store(key, ttl, entry, response)
+
+    def _store(self, key, ttl, entry, response) -> bytes:
+        """ Caches the response of a (conditional) request for key, returns the raw body """
+        now = time.time()
+        if response.status_code == 304 and entry is not None:
+            self.stats['revalidated'] += 1
+            self.put(key, CacheEntry(entry.body, response.headers.get('ETag', entry.etag), now + ttl))
+            return entry.body
+
+        body = response.content
+        self.put(key, CacheEntry(body, response.headers.get('ETag'), now + ttl))
+        return body
+
+    def _memPut(self, key: str, entry: CacheEntry):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._entries_lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.stats['evictions'] += 1
+
+    def _diskGet(self, key: str) -> Optional[CacheEntry]:
+        if self.disk is None:
+            return None
+        with self._disk_lock:
+            row = self.disk.execute("SELECT body, etag, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        return CacheEntry(bytes(row[0]), row[1], row[2]) if row is not None else None
+
+    def _diskPut(self, key: str, entry: CacheEntry):
+        if self.disk is None or len(entry.body) > self.max_disk_bytes:
+            return
+        with self._disk_lock:
+            old = self.disk.execute("SELECT length(body) FROM responses WHERE key = ?", (key,)).fetchone()
+            self.disk.execute("INSERT OR REPLACE INTO responses (key, body, etag, expires, stored) VALUES (?, ?, ?, ?, ?)",
+                              (key, entry.body, entry.etag, entry.expires, time.time()))
+            self.disk_size += len(entry.body) - (old[0] if old is not None else 0)
+            self._disk_writes += 1
+            if self._disk_writes % 1000 == 0 or self.disk_size > self.max_disk_bytes:
+                self._diskPrune()
+
+    def _diskPrune(self):
+        """ Deletes the least recently stored rows beyond max_disk_entries, then until the bytes fit again """
+        with self._disk_lock:
+            self.disk.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY stored DESC LIMIT -1 OFFSET ?
+                )""", (self.max_disk_entries,))
+            self.disk_size = self.disk.execute("SELECT COALESCE(SUM(length(body)), 0) FROM responses").fetchone()[0]
+            if self.disk_size <= self.max_disk_bytes:
+                return
+            # prune down to 90% so a full cache does not prune on every put
+            excess = self.disk_size - int(self.max_disk_bytes * 0.9)
+            oldest = []
+            for key, size in self.disk.execute("SELECT key, length(body) FROM responses ORDER BY stored"):
+                if excess <= 0:
+                    break
+                oldest.append((key,))
+                excess -= size
+                self.disk_size -= size
+            self.disk.executemany("DELETE FROM responses WHERE key = ?", oldest)
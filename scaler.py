@@ -0,0 +1,122 @@
+import numpy as np
+from spoticolor.arrayBlob import encodeArray, decodeArray
+
+
+class SegmentScaler:
+    """
+    Per-column scaler for the (n_segments, 31) segment matrices.
+    Statistics are accumulated incrementally (partial_fit) and persisted with a version in the db,
+    so every dataset build scales with the same numbers no matter which tracks it loaded.
+    start, duration, confidence are min-max scaled, the loudness features standardized, pitches and timbre left as is.
+    """
+    NAME = 'segments'
+    N_COLUMNS = 31
+    MINMAX_COLUMNS = [0, 1, 2]  # start, duration, confidence
+    STANDARD_COLUMNS = [3, 4, 5, 6]  # loudness_start, loudness_max, loudness_max_time, loudness_end
+
+    def __init__(self, version=0):
+        self.version = version
+        self.count = 0
+        self.mean = np.zeros(self.N_COLUMNS)
+        self.m2 = np.zeros(self.N_COLUMNS)
+        self.min = np.full(self.N_COLUMNS, np.inf)
+        self.max = np.full(self.N_COLUMNS, -np.inf)
+
+    # ---- Fitting ----
+    def partial_fit(self, X: np.ndarray):
+        """
+        Merges the statistics of X into the running ones (Chan et al. parallel variance), one pass over X.
+        """
+        X = np.asarray(X, dtype=np.float64).reshape(-1, self.N_COLUMNS)
+        n = len(X)
+        if n == 0:
+            return self
+        mean = X.mean(axis=0)
+        m2 = ((X - mean) ** 2).sum(axis=0)
+
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+        np.minimum(self.min, X.min(axis=0), out=self.min)
+        np.maximum(self.max, X.max(axis=0), out=self.max)
+        return self
+
+    def merge(self, other: 'SegmentScaler'):
+        """
+        Adds the statistics accumulated by another scaler.
+        """
+        if other.count == 0:
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / total)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / total)
+        self.count = total
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        return self
+
+    # ---- Scaling ----
+    def transform(self, X: np.ndarray, copy=False) -> np.ndarray:
+        """
+        Scales X in place (or a float32 copy if asked, or X is read only like stored segment blobs).
+        """
+        if copy or not X.flags.writeable:
+            X = np.array(X, dtype=np.float32)
+        if self.count == 0 or len(X) == 0:
+            return X
+
+        mm = self.MINMAX_COLUMNS
+        value_range = self.max[mm] - self.min[mm]
+        value_range[value_range == 0] = 1
+        X[..., mm] -= self.min[mm]
+        X[..., mm] /= value_range
+
+        st = self.STANDARD_COLUMNS
+        std = np.sqrt(self.m2[st] / self.count)
+        std[std == 0] = 1
+        X[..., st] -= self.mean[st]
+        X[..., st] /= std
+        return X
+
+    # ---- Persistence ----
+    def toBlob(self) -> bytes:
+        state = np.stack([np.full(self.N_COLUMNS, self.count, dtype=np.float64),
+                          self.mean, self.m2, self.min, self.max])
+        return encodeArray(state, self.version)
+
+    @classmethod
+    def fromBlob(cls, version, blob) -> 'SegmentScaler':
+        scaler = cls(version)
+        count, mean, m2, min_, max_ = np.array(decodeArray(blob))
+        scaler.count = int(count[0])
+        scaler.mean, scaler.m2, scaler.min, scaler.max = mean, m2, min_, max_
+        return scaler
+
+    @classmethod
+    def load(cls, storage) -> 'SegmentScaler':
+        """
+        Persisted scaler, an empty one (count 0) if it was never fitted.
+        """
+        state = storage.getScalerState(cls.NAME)
+        if state is None:
+            return cls()
+        return cls.fromBlob(*state)
+
+    def commit(self, storage) -> 'SegmentScaler':
+        """
+        Merges this scaler into the persisted one and bumps its version, so it must only hold
+        statistics of tracks that are not in the persisted scaler yet (start from SegmentScaler(), not load).
+        Merging inside one write transaction keeps concurrent yanks from overwriting each other.
+        Returns the persisted scaler.
+        """
+        def merge(version, blob):
+            stored = self.fromBlob(version, blob) if blob is not None else type(self)()
+            stored.merge(self)
+            stored.version = (version or 0) + 1
+            return stored.version, stored.toBlob()
+
+        version, blob = storage.mergeScalerState(self.NAME, merge)
+        return self.fromBlob(version, blob)
@@ -0,0 +1,76 @@
+from typing import Callable, Dict, Hashable
+from concurrent.futures import Future
+import threading
+from spoticolor import metrics
+
+
+class SingleFlight:
+    """
+    Process wide registry of in-flight requests. Identical requests made while one is outstanding
+    share its result (or exception) instead of going out again. Entries are dropped as soon as the
+    request finishes, caching finished results is ResponseCache's job.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        if SingleFlight._instance is None:
+            with SingleFlight._lock:
+                if SingleFlight._instance is None:
+                    SingleFlight._instance = SingleFlight()
+        return SingleFlight._instance
+
+    def __init__(self):
+        self.inflight: Dict[Hashable, Future] = {}
+        self.shared = 0  # requests that joined an outstanding one
+        self._inflight_lock = threading.Lock()
+        metrics.CallbackGauge('spoticolor_singleflight_shared_total', "Requests that joined an identical in-flight one",
+                              func=lambda: self.shared, type='counter')
+
+    def submit(self, key: Hashable, start: Callable[[], Future]) -> Future:
+        """
+        Future of the outstanding request for key, or of start() if there is none.
+        start must not block, e.g. SpotifyAPI.enqueue_request.
+        """
+        with self._inflight_lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.shared += 1
+                return future
+            future = start()
+            self.inflight[key] = future
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future
+
+    def call(self, key: Hashable, func: Callable, *args, **kwargs):
+        """
+        Runs func in the calling thread unless the same key is already running elsewhere,
+        then waits for that result instead.
+        """
+        with self._inflight_lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.shared += 1
+                owner = False
+            else:
+                future = Future()
+                self.inflight[key] = future
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._forget(key, future)
+
+    def _forget(self, key, future):
+        with self._inflight_lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
@@ -1,11 +1,80 @@
-from typing import Dict, Union
+from typing import Dict, Iterable, Tuple, Union
 from pathlib import Path
+from itertools import islice
 import sqlite3
 import datetime
+import os
+import threading
 import numpy as np
-from sklearn.preprocessing import MinMaxScaler, StandardScaler
 import json
+import orjson
 import pickle
+from spoticolor.arrayBlob import encodeArray, decodeArray, isArrayBlob, MAGIC
+from spoticolor.scaler import SegmentScaler
+from spoticolor.trackCodec import TrackCodec, isCompressed, readHeader
+
+
+# Column order of the (n_segments, 31) segment matrix fed to the model
+SEGMENT_FEATURES = ['start', 'duration', 'confidence', 'loudness_start',
+                    'loudness_max', 'loudness_max_time', 'loudness_end']
+SEGMENT_SIZE = len(SEGMENT_FEATURES) + 12 + 12  # + pitches + timbre
+
+# tracks.status values, anything else is the error status code returned by the API
+TRACK_OK = 'ok'
+TRACK_PENDING = 'pending'
+
+# yank_jobs.stage values in the order a yank goes through them
+YANK_STAGES = ['sources', 'analyses', 'dataset', 'done']
+
+
+def extractSegments(track_data: Dict) -> np.ndarray:
+    """
+    Builds the float32 (n_segments, 31) matrix from a decoded audio analysis.
+    """
+    segments = track_data.get('segments') or []
+    if not segments:
+        return np.zeros((0, SEGMENT_SIZE), dtype=np.float32)
+    return np.array([[seg[f] for f in SEGMENT_FEATURES] + seg['pitches'] + seg['timbre']
+                     for seg in segments], dtype=np.float32)
+
+
+def trackStatus(track_data: Dict) -> str:
+    """
+    Value for tracks.status of a decoded audio analysis, set once at ingest.
+    """
+    if track_data is None:
+        return TRACK_PENDING
+    if 'error' in track_data:
+        error = track_data['error']
+        return str(error.get('status', 'error')) if isinstance(error, dict) else 'error'
+    return TRACK_OK
+
+
+def encodeTrack(track_id, track_data: Dict) -> Tuple:
+    """
+    Row for Storage.addTracksBulk from a decoded audio analysis.
+    """
+    return (track_id, orjson.dumps(track_data).decode('utf-8'), None,
+            encodeSegments(track_data), trackStatus(track_data))
+
+
+def encodeSegments(track_data: Dict) -> bytes:
+    """
+    Segment matrix blob stored in tracks.track_segments, None for analyses with errors.
+    """
+    if track_data is None or 'error' in track_data:
+        return None
+    return encodeArray(extractSegments(track_data))
+
+
+def _batched(iterable, size):
+    """ Yields lists of at most size items from iterable """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 
 class Storage:
@@ -14,11 +83,71 @@ class Storage:
     Provides the functionality for all modules to get and push data from/to the db.
     """
 
-    def __init__(self):
-        self.db_file = Path('data.db')
+    # Applied to every pooled connection, WAL lets readers run while a yank is writing
+    PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # safe with WAL, only the checkpoint fsyncs
+        'cache_size': -64000,  # in KiB -> 64MB page cache per connection
+        'mmap_size': 268435456,  # 256MB
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self, db_file=None, busy_timeout=30.0):
+        """
+        db_file: sqlite file, defaults to $SPOTICOLOR_DB or data.db
+        busy_timeout: seconds a connection waits on a locked db before raising sqlite3.OperationalError
+        """
+        self.db_file = Path(db_file or os.environ.get('SPOTICOLOR_DB', 'data.db'))
         print(self.db_file)
-        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
-        self.curs = self.conn.cursor()
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._pool = {}  # thread ident -> (thread, connection)
+        self._pool_lock = threading.Lock()
+        self._codecs = {}  # dict_id -> TrackCodec, see trackCodec.py
+        self._active_codec = False  # not looked up yet
+
+    # ---- Connection pool ----
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        Connection owned by the calling thread, created on first use.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @property
+    def curs(self) -> sqlite3.Cursor:
+        return self.conn.cursor()
+
+    def _connect(self) -> sqlite3.Connection:
+        # check_same_thread=False only so close()/the pool sweep can close connections of other threads
+        conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout, check_same_thread=False)
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+        for pragma, value in self.PRAGMAS.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+
+        current = threading.current_thread()
+        with self._pool_lock:
+            # Flask spawns a thread per request, close what finished threads left behind
+            for ident, (thread, old_conn) in list(self._pool.items()):
+                if not thread.is_alive():
+                    old_conn.close()
+                    del self._pool[ident]
+            self._pool[current.ident] = (current, conn)
+        return conn
+
+    def close(self):
+        """
+        Closes every pooled connection.
+        """
+        with self._pool_lock:
+            for _, conn in self._pool.values():
+                conn.close()
+            self._pool.clear()
+        self._local = threading.local()
 
     # ---- Create ----
     def createTables(self):
@@ -37,7 +166,9 @@ class Storage:
             CREATE TABLE IF NOT EXISTS tracks (
                 track_id TEXT PRIMARY KEY,
                 track_data TEXT NOT NULL,
-                track_tensor BLOB
+                track_tensor BLOB,
+                track_segments BLOB,
+                status TEXT NOT NULL DEFAULT 'pending'
             );
             """)
             # Modified user_tracks table creation
@@ -59,6 +190,100 @@ class Storage:
                 FOREIGN KEY(user_id) REFERENCES users(user_id)
             );
             """)
+            # Shared dictionaries for compressed track_data, the active one is used at ingest
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS track_codecs (
+                dict_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                codec INTEGER NOT NULL,
+                level INTEGER,
+                dictionary BLOB,
+                active INTEGER NOT NULL DEFAULT 0,
+                created TIMESTAMP
+            );
+            """)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS scalers (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                state BLOB NOT NULL,
+                updated TIMESTAMP
+            );
+            """)
+            # Durable yank progress, see dataYanker.yank
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS yank_jobs (
+                user_id TEXT PRIMARY KEY,
+                refresh_token TEXT,
+                stage TEXT NOT NULL DEFAULT 'sources',
+                status TEXT NOT NULL DEFAULT 'running',
+                error TEXT,
+                started TIMESTAMP,
+                updated TIMESTAMP
+            );
+            """)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS yank_checkpoints (
+                user_id TEXT,
+                source TEXT,
+                next_offset INTEGER NOT NULL DEFAULT 0,
+                cursor TEXT,
+                done INTEGER NOT NULL DEFAULT 0,
+                high_water TEXT,
+                updated TIMESTAMP,
+                PRIMARY KEY (user_id, source)
+            );
+            """)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS yank_track_ids (
+                user_id TEXT,
+                track_id TEXT,
+                PRIMARY KEY (user_id, track_id)
+            ) WITHOUT ROWID;
+            """)
+            # Newest item seen per user and source (saved: added_at, recently_played: cursor), for delta syncs
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                user_id TEXT,
+                source TEXT,
+                high_water TEXT NOT NULL,
+                updated TIMESTAMP,
+                PRIMARY KEY (user_id, source)
+            );
+            """)
+            # Resolved track ids of every playlist at its snapshot_id, a playlist is only paged again once that changes
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS playlist_snapshots (
+                playlist_id TEXT PRIMARY KEY,
+                snapshot_id TEXT NOT NULL,
+                track_ids TEXT NOT NULL,
+                updated TIMESTAMP
+            );
+            """)
+        self.migrateTables()
+
+    def migrateTables(self):
+        """
+        Brings tables created by older versions up to date with createTables.
+        """
+        with self.conn as conn:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(tracks)')]
+            if 'track_segments' not in columns:
+                conn.execute('ALTER TABLE tracks ADD COLUMN track_segments BLOB')
+            if 'status' not in columns:
+                conn.execute("ALTER TABLE tracks ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+                # last time we ever scan the json text for errors
+                conn.execute("""
+                UPDATE tracks SET status = CASE
+                    WHEN track_data NOT LIKE '%"error":%' THEN 'ok'
+                    WHEN json_valid(track_data) THEN COALESCE(CAST(json_extract(track_data, '$.error.status') AS TEXT), 'error')
+                    ELSE 'error'
+                END;
+                """)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tracks_status ON tracks(status)')
+            # (user_id, track_id) lookups are already served by the primary key index
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_user_tracks_track ON user_tracks(track_id, user_id)')
+            if 'high_water' not in [row[1] for row in conn.execute('PRAGMA table_info(yank_checkpoints)')]:
+                conn.execute('ALTER TABLE yank_checkpoints ADD COLUMN high_water TEXT')
 
     # ---- User - CRUD Operations ----
     # Users - Create
@@ -90,8 +315,9 @@ class Storage:
             return conn.execute(sql, (user_id,)).fetchone()
 
     def fetch_all_users(self):
-        self.curs.execute("SELECT * FROM users")
-        return self.curs.fetchall()
+        curs = self.curs
+        curs.execute("SELECT * FROM users")
+        return curs.fetchall()
 
     def getUserByMail(self, email):
         with self.conn as conn:
@@ -115,6 +341,119 @@ class Storage:
             conn.execute(sql, (user_id,))
             conn.commit()
 
+    # ---- Yank jobs ----
+    def startYankJob(self, user_id, refresh_token):
+        """
+        Returns the stage the yank of user_id has to start from.
+        An unfinished job (crashed or interrupted by a restart) is resumed, a finished one starts over.
+        """
+        now = datetime.datetime.now()
+        with self.conn as conn:
+            row = conn.execute('SELECT stage, status FROM yank_jobs WHERE user_id = ?', (user_id,)).fetchone()
+            if row is not None and row[1] != 'done':
+                conn.execute("UPDATE yank_jobs SET status = 'running', refresh_token = ?, error = NULL, updated = ? WHERE user_id = ?",
+                             (refresh_token, now, user_id))
+                return row[0]
+            conn.execute('DELETE FROM yank_checkpoints WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM yank_track_ids WHERE user_id = ?', (user_id,))
+            conn.execute("""
+            INSERT INTO yank_jobs (user_id, refresh_token, stage, status, error, started, updated)
+            VALUES (?, ?, 'sources', 'running', NULL, ?, ?)
+            ON CONFLICT(user_id)
+            DO UPDATE SET refresh_token=excluded.refresh_token, stage='sources', status='running', error=NULL,
+                          started=excluded.started, updated=excluded.updated;
+            """, (user_id, refresh_token, now, now))
+        return YANK_STAGES[0]
+
+    def getYankJob(self, user_id):
+        """ (stage, status, error) of the user's yank, None if there never was one """
+        with self.conn as conn:
+            return conn.execute('SELECT stage, status, error FROM yank_jobs WHERE user_id = ?', (user_id,)).fetchone()
+
+    def unfinishedYankJobs(self):
+        """ [(user_id, refresh_token)] of every yank that did not get to the end """
+        with self.conn as conn:
+            return conn.execute("SELECT user_id, refresh_token FROM yank_jobs WHERE status != 'done'").fetchall()
+
+    def setYankStage(self, user_id, stage, status='running', error=None):
+        """ stage is one of YANK_STAGES, stage 'done' also drops the checkpoints which are no longer needed """
+        if stage == 'done':
+            status = 'done'
+        with self.conn as conn:
+            conn.execute('UPDATE yank_jobs SET stage = ?, status = ?, error = ?, updated = ? WHERE user_id = ?',
+                         (stage, status, error, datetime.datetime.now(), user_id))
+            if stage == 'done':
+                conn.execute('DELETE FROM yank_checkpoints WHERE user_id = ?', (user_id,))
+                conn.execute('DELETE FROM yank_track_ids WHERE user_id = ?', (user_id,))
+
+    def getYankCheckpoint(self, user_id, source):
+        """ (next_offset, cursor, done) of a source of the user's yank, (0, None, False) if it was not started """
+        with self.conn as conn:
+            row = conn.execute('SELECT next_offset, cursor, done FROM yank_checkpoints WHERE user_id = ? AND source = ?',
+                               (user_id, source)).fetchone()
+        return (row[0], row[1], bool(row[2])) if row is not None else (0, None, False)
+
+    def saveYankCheckpoint(self, user_id, source, track_ids, next_offset=0, cursor=None, done=False, high_water=None):
+        """
+        Records the track ids a page of source produced together with where the next page starts,
+        in one transaction so a resumed yank never skips or loses a page.
+        high_water: new sync_state of source. Kept with the checkpoint (None keeps the one stored before,
+        so a resumed yank need not know it) and moved to sync_state in the transaction that marks source done.
+        """
+        now = datetime.datetime.now()
+        with self.conn as conn:
+            conn.executemany('INSERT OR IGNORE INTO yank_track_ids (user_id, track_id) VALUES (?, ?)',
+                             ((user_id, track_id) for track_id in track_ids if track_id is not None))
+            conn.execute("""
+            INSERT INTO yank_checkpoints (user_id, source, next_offset, cursor, done, high_water, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, source)
+            DO UPDATE SET next_offset=excluded.next_offset, cursor=excluded.cursor, done=excluded.done,
+                          high_water=COALESCE(excluded.high_water, yank_checkpoints.high_water), updated=excluded.updated;
+            """, (user_id, source, next_offset, cursor, int(done),
+                  str(high_water) if high_water is not None else None, now))
+            if done:
+                conn.execute("""
+                INSERT INTO sync_state (user_id, source, high_water, updated)
+                SELECT user_id, source, high_water, ? FROM yank_checkpoints
+                WHERE user_id = ? AND source = ? AND high_water IS NOT NULL
+                ON CONFLICT(user_id, source) DO UPDATE SET high_water=excluded.high_water, updated=excluded.updated;
+                """, (now, user_id, source))
+
+    def getSyncState(self, user_id):
+        """ {source: high_water} of the user's last sync, empty for a new user """
+        with self.conn as conn:
+            return dict(conn.execute('SELECT source, high_water FROM sync_state WHERE user_id = ?', (user_id,)).fetchall())
+
+    def resetSyncState(self, user_id):
+        """ Makes the next yank of the user a full one """
+        with self.conn as conn:
+            conn.execute('DELETE FROM sync_state WHERE user_id = ?', (user_id,))
+
+    def getYankTrackIds(self, user_id):
+        with self.conn as conn:
+            return [row[0] for row in conn.execute('SELECT track_id FROM yank_track_ids WHERE user_id = ?', (user_id,))]
+
+    # ---- Playlist snapshots ----
+    def getPlaylistSnapshots(self, playlist_ids) -> Dict[str, Tuple[str, list]]:
+        """ {playlist_id: (snapshot_id, track_ids)} of the stored playlists among playlist_ids """
+        snapshots = {}
+        with self.conn as conn:
+            for batch in _batched(playlist_ids, 500):
+                rows = conn.execute(f'SELECT playlist_id, snapshot_id, track_ids FROM playlist_snapshots '
+                                    f'WHERE playlist_id IN ({",".join("?" * len(batch))})', batch)
+                snapshots.update((playlist_id, (snapshot_id, orjson.loads(track_ids)))
+                                 for playlist_id, snapshot_id, track_ids in rows)
+        return snapshots
+
+    def savePlaylistSnapshot(self, playlist_id, snapshot_id, track_ids):
+        with self.conn as conn:
+            conn.execute("""
+            INSERT INTO playlist_snapshots (playlist_id, snapshot_id, track_ids, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT(playlist_id) DO UPDATE SET
+                snapshot_id=excluded.snapshot_id, track_ids=excluded.track_ids, updated=excluded.updated;
+            """, (playlist_id, snapshot_id, orjson.dumps(list(track_ids)).decode('utf-8'), datetime.datetime.now()))
+
     # ---- Tracks - CRUD Operations ----
     # Tracks - Create
     def addTrack(self, track_id, track_data=None, track_tensor=None):
@@ -128,36 +467,147 @@ class Storage:
 
             conn.commit()
 
+    # Tracks - Compression
+    def _getCodec(self, dict_id) -> TrackCodec:
+        codec = self._codecs.get(dict_id)
+        if codec is None:
+            with self.conn as conn:
+                row = conn.execute('SELECT codec, level, dictionary FROM track_codecs WHERE dict_id = ?', (dict_id,)).fetchone()
+            if row is None:
+                raise ValueError(f"Unknown track codec dictionary {dict_id}")
+            codec = self._codecs[dict_id] = TrackCodec(row[0], dict_id, row[2], row[1])
+        return codec
+
+    def activeTrackCodec(self):
+        """
+        Codec new track_data is compressed with, None if compression was never enabled (see trackCodec.py).
+        """
+        if self._active_codec is False:
+            with self.conn as conn:
+                row = conn.execute('SELECT dict_id FROM track_codecs WHERE active = 1').fetchone()
+            self._active_codec = self._getCodec(row[0]) if row else None
+        return self._active_codec
+
+    def addTrackCodec(self, codec, dictionary=None, level=None):
+        """
+        Stores a (trained) dictionary and makes it the one used at ingest, returns its dict_id.
+        level: ingest compression level, None for the cheap default of the codec
+        """
+        with self.conn as conn:
+            conn.execute('UPDATE track_codecs SET active = 0')
+            cursor = conn.execute('INSERT INTO track_codecs (codec, level, dictionary, active, created) VALUES (?, ?, ?, 1, ?)',
+                                  (codec, level, dictionary, datetime.datetime.now()))
+        self._active_codec = False
+        return cursor.lastrowid
+
+    def inflateTrackData(self, track_data):
+        """
+        Returns track_data as json text, whether it is stored compressed or not.
+        """
+        if track_data is None or not isCompressed(track_data):
+            return track_data
+        _, dict_id = readHeader(track_data)
+        return self._getCodec(dict_id).decompress(track_data).decode('utf-8')
+
+    def deflateTrackData(self, track_data):
+        """
+        Compresses json text with the active codec if there is one.
+        """
+        codec = self.activeTrackCodec()
+        if codec is None or not isinstance(track_data, str):
+            return track_data
+        return codec.compress(track_data)
+
+    def _inflateRows(self, rows):
+        return [(track_id, self.inflateTrackData(track_data)) for track_id, track_data in rows]
+
+    def compressTracks(self, batch_size=200, level=None):
+        """
+        Rewrites every plain json track_data with the active codec, returns the number of tracks compressed.
+        level: overrides the codec's ingest level, the rewrite runs offline and can afford a slow one
+        """
+        codec = self.activeTrackCodec()
+        if codec is None:
+            raise ValueError("No active track codec, add one with addTrackCodec first")
+        if level is not None:
+            codec = codec.withLevel(level)
+        nTracks = 0
+        while True:
+            with self.conn as conn:
+                rows = conn.execute(
+                    "SELECT track_id, track_data FROM tracks WHERE typeof(track_data) = 'text' LIMIT ?", (batch_size,)).fetchall()
+            if not rows:
+                break
+            with self.conn as conn:
+                conn.executemany('UPDATE tracks SET track_data = ? WHERE track_id = ?',
+                                 [(codec.compress(track_data), track_id) for track_id, track_data in rows])
+            nTracks += len(rows)
+        return nTracks
+
+    def sampleTrackData(self, n=1000):
+        """
+        Random valid track_data as utf-8 json bytes, used to train / evaluate compression dictionaries.
+        """
+        with self.conn as conn:
+            rows = conn.execute("SELECT track_id, track_data FROM tracks WHERE status = 'ok' ORDER BY RANDOM() LIMIT ?", (n,)).fetchall()
+        return [track_data.encode('utf-8') for _, track_data in self._inflateRows(rows)]
+
     # Tracks - Read
     def getTrack(self, track_id):
         with self.conn as conn:
-            sql = "SELECT track_id, track_data FROM tracks WHERE track_id = ? AND track_data NOT LIKE '%\"error\":%'"
-            return conn.execute(sql, (track_id,)).fetchone()
+            sql = "SELECT track_id, track_data FROM tracks WHERE track_id = ? AND status = 'ok'"
+            row = conn.execute(sql, (track_id,)).fetchone()
+        return None if row is None else (row[0], self.inflateTrackData(row[1]))
 
     def getTracks(self, track_ids):
         with self.conn as conn:
             values = ', '.join('?' for _ in track_ids)
-            sql = f"SELECT track_id, track_data FROM tracks WHERE track_id IN ({values}) AND track_data NOT LIKE '%\"error\":%'"
-            return conn.execute(sql, track_ids).fetchall()
+            sql = f"SELECT track_id, track_data FROM tracks WHERE track_id IN ({values}) AND status = 'ok'"
+            return self._inflateRows(conn.execute(sql, track_ids).fetchall())
 
     def getTrackTensor(self, track_id):
+        """
+        Model output stored by updateTrackTensor as a read only zero-copy array, None if there is none.
+        """
         cursor = self.conn.cursor()
         cursor.execute("""
         SELECT track_tensor FROM tracks WHERE track_id = ?;
         """, (track_id,))
         result = cursor.fetchone()
-        if result and result[0]:
-            return pickle.loads(result[0])
+        if result and isArrayBlob(result[0]):
+            return decodeArray(result[0])
         return None
 
+    def getTrackTensors(self, track_ids):
+        """
+        Batch version of getTrackTensor, stacks all found tensors into one zero-padded array.
+        Returns (found_track_ids, (n_tracks, max_segments, emb) array, n_segments per track)
+        """
+        track_ids = list(track_ids)
+        with self.conn as conn:
+            values = ', '.join('?' for _ in track_ids)
+            rows = conn.execute(
+                f"SELECT track_id, track_tensor FROM tracks WHERE track_id IN ({values}) AND track_tensor IS NOT NULL", track_ids).fetchall()
+        found = {track_id: decodeArray(blob) for track_id, blob in rows if isArrayBlob(blob)}
+        found_ids = [track_id for track_id in track_ids if track_id in found]
+        if not found_ids:
+            return found_ids, None, np.zeros(0, dtype=np.int64)
+
+        tensors = [found[track_id] for track_id in found_ids]
+        lengths = np.array([len(t) for t in tensors], dtype=np.int64)
+        stacked = np.zeros((len(tensors), lengths.max()) + tensors[0].shape[1:], dtype=tensors[0].dtype)
+        for i, tensor in enumerate(tensors):
+            stacked[i, :len(tensor)] = tensor
+        return found_ids, stacked, lengths
+
     def getValidTracks(self):
         """
         Extracts and returns valid track data from the database, excluding any with errors.
         """
         with self.conn as conn:
             cursor = conn.execute(
-                "SELECT track_id, track_data FROM tracks WHERE track_data NOT LIKE '%\"error\":%'")
-            return cursor.fetchall()
+                "SELECT track_id, track_data FROM tracks WHERE status = 'ok'")
+            return self._inflateRows(cursor.fetchall())
 
     def getValidUserTracks(self, userid):
         """
@@ -165,21 +615,109 @@ class Storage:
         """
         with self.conn as conn:
             cursor = conn.execute(
-                "SELECT tracks.track_id, tracks.track_data FROM tracks INNER JOIN user_tracks ON tracks.track_id = user_tracks.track_id WHERE user_tracks.user_id = ?", (userid,))
-            return cursor.fetchall()
+                "SELECT tracks.track_id, tracks.track_data FROM tracks INNER JOIN user_tracks ON tracks.track_id = user_tracks.track_id WHERE user_tracks.user_id = ? AND tracks.status = 'ok'", (userid,))
+            return self._inflateRows(cursor.fetchall())
+
+    def _streamRows(self, sql, params=(), chunk_size=256):
+        """
+        Yields lists of at most chunk_size rows from a cursor, the result set is never fetched at once.
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cursor.close()
+
+    def streamValidTracks(self, chunk_size=256, userid=None):
+        """
+        Streaming getValidTracks/getValidUserTracks, yields chunks of [(track_id, decoded track_data)].
+        """
+        if userid is None:
+            rows = self._streamRows("SELECT track_id, track_data FROM tracks WHERE status = 'ok'",
+                                    chunk_size=chunk_size)
+        else:
+            rows = self._streamRows(
+                "SELECT tracks.track_id, tracks.track_data FROM tracks INNER JOIN user_tracks ON tracks.track_id = user_tracks.track_id WHERE user_tracks.user_id = ? AND tracks.status = 'ok'",
+                (userid,), chunk_size)
+        for chunk in rows:
+            yield self.decodeTracks(chunk)
+
+    def streamSegmentMatrices(self, chunk_size=256, track_ids=None, userid=None):
+        """
+        Yields chunks of [(track_id, float32 (n_segments, 31) matrix)] straight from the stored segment blobs,
+        only rows that were never backfilled fall back to decoding the json.
+        """
+        # track_data is only read for rows without a segment blob
+        columns = "tracks.track_id, tracks.track_segments, CASE WHEN tracks.track_segments IS NULL THEN tracks.track_data END"
+        if userid is not None:
+            rows = self._streamRows(
+                f"SELECT {columns} FROM tracks INNER JOIN user_tracks ON tracks.track_id = user_tracks.track_id WHERE user_tracks.user_id = ? AND tracks.status = 'ok'",
+                (userid,), chunk_size)
+        elif track_ids is not None:
+            track_ids = list(track_ids)
+            values = ', '.join('?' for _ in track_ids)
+            rows = self._streamRows(
+                f"SELECT {columns} FROM tracks WHERE track_id IN ({values}) AND status = 'ok'", track_ids, chunk_size)
+        else:
+            rows = self._streamRows(f"SELECT {columns} FROM tracks WHERE status = 'ok'", chunk_size=chunk_size)
+
+        for chunk in rows:
+            matrices = []
+            for track_id, track_segments, track_data in chunk:
+                if track_segments is not None:
+                    matrices.append((track_id, decodeArray(track_segments)))
+                    continue
+                for _, decoded_data in self.decodeTracks([(track_id, track_data)]):
+                    matrices.append((track_id, extractSegments(decoded_data)))
+            yield matrices
+
+    def getSegmentMatrices(self, track_ids=None, userid=None):
+        """
+        Returns [(track_id, float32 (n_segments, 31) matrix)], see streamSegmentMatrices.
+        """
+        return [matrix for chunk in self.streamSegmentMatrices(track_ids=track_ids, userid=userid) for matrix in chunk]
+
+    def backfillSegments(self, batch_size=200):
+        """
+        One-off: fills track_segments for tracks stored before segment blobs existed.
+        """
+        nTracks = 0
+        while True:
+            with self.conn as conn:
+                rows = conn.execute(
+                    "SELECT track_id, track_data FROM tracks WHERE track_segments IS NULL AND status = 'ok' LIMIT ?", (batch_size,)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for track_id, decoded_data in self.decodeTracks(rows):
+                updates.append((encodeSegments(decoded_data), track_id))
+            # rows that fail to decode get an empty matrix so they are not picked up again
+            decoded_ids = {track_id for _, track_id in updates}
+            updates.extend((encodeArray(np.zeros((0, SEGMENT_SIZE), dtype=np.float32)), track_id)
+                           for track_id, _ in rows if track_id not in decoded_ids)
+            with self.conn as conn:
+                conn.executemany('UPDATE tracks SET track_segments = ? WHERE track_id = ?', updates)
+            nTracks += len(updates)
+        print(f"Backfilled segments for {nTracks} tracks")
+        return nTracks
 
     def decodeTracks(self, tracks):
         if tracks is None:  # ehhh not amazing but for now im tired
-            tracks = self.getValidTracks()
+            return [track for chunk in self.streamValidTracks() for track in chunk]
 
         decoded_tracks = []
 
         for track_id, track_data in tracks:
             try:
-                decoded_data = json.loads(track_data)
+                decoded_data = json.loads(self.inflateTrackData(track_data))
                 decoded_tracks.append((track_id, decoded_data))
 
-            except json.JSONDecodeError:
+            except ValueError:  # bad json or corrupt compressed data
                 # Do something idk
                 print(
                     f"Error processing data for track_id: {track_id}. Data: {track_data}")
@@ -187,77 +725,139 @@ class Storage:
 
         return decoded_tracks
 
-    def scaleFeatures(self, tracks_data, features):
-        unscaled_features = features
-        scaled_features = [f for f in features if f not in unscaled_features]
-
-        scalers = {feature: (MinMaxScaler() if feature not in [
-                             'loudness_max_time', 'loudness_start', 'loudness_max', 'loudness_end'] else StandardScaler()) for feature in scaled_features}
-
-        # Prepare feature arrays
-        feature_arrays = {feature: [] for feature in scaled_features}
-        for _, track_data in tracks_data:
-            for seg in track_data['segments']:
-                for feature in scaled_features:
-                    feature_arrays[feature].append(seg[feature])
-
-        # Scale features in bulk
-        for feature in scaled_features:
-            all_values = np.array(feature_arrays[feature]).reshape(-1, 1)
-            scalers[feature].fit(all_values)
-            scaled_values = scalers[feature].transform(all_values)
-            index = 0
-            for _, track_data in tracks_data:
-                for seg in track_data['segments']:
-                    seg[feature] = scaled_values[index]
-                    index += 1
-
-    def padTracks(self, tracks_data, features, max_segments=None):
-        segment_size = 31
+    # ---- Scaler ----
+    def getScalerState(self, name):
+        """
+        Returns (version, state blob) of a persisted scaler, None if it does not exist.
+        """
+        with self.conn as conn:
+            return conn.execute('SELECT version, state FROM scalers WHERE name = ?', (name,)).fetchone()
+
+    def mergeScalerState(self, name, merge):
+        """
+        Read-modify-write of a scaler inside one write transaction.
+        merge: (version, state blob or None) -> (new version, new state blob)
+        """
+        conn = self.conn
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT version, state FROM scalers WHERE name = ?', (name,)).fetchone()
+            version, state = merge(*(row or (0, None)))
+            conn.execute('''
+            INSERT INTO scalers (name, version, state, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET version=excluded.version, state=excluded.state, updated=excluded.updated;
+            ''', (name, version, state, datetime.datetime.now()))
+        return version, state
+
+    def getSegmentScaler(self) -> SegmentScaler:
+        """
+        Persisted segment scaler, fitted once over every stored track if it does not exist yet.
+        The scan runs without holding the write lock, only storing the result is a transaction, and a fit
+        stored by someone else meanwhile wins. It is stored even when empty: once it exists yanks merge the
+        tracks they store into it (see dataYanker.storeAnalyses), tracks stored before are covered by this fit.
+        """
+        state = self.getScalerState(SegmentScaler.NAME)
+        if state is not None:
+            return SegmentScaler.fromBlob(*state)
 
-        if max_segments is not None:
-            padded_tracks = np.zeros(
-                (len(tracks_data), max_segments, segment_size), dtype=np.float32)
-        else:
-            padded_tracks = []
+        fresh = SegmentScaler(version=1)
+        for chunk in self.streamSegmentMatrices():
+            for _, matrix in chunk:
+                fresh.partial_fit(matrix)
 
-        for i, (_, track_data) in enumerate(tracks_data):
-            segments = track_data['segments']
-            num_segments = len(segments)
+        def firstFit(version, blob):
+            if blob is not None:  # fitted elsewhere while we scanned, its yanks already merge into that one
+                return version, blob
+            return fresh.version, fresh.toBlob()
 
-            flattened_segments = np.array([
-                np.concatenate(([seg[f] for f in features],
-                               seg['pitches'], seg['timbre']))
-                for seg in segments], dtype=np.float32)
+        return SegmentScaler.fromBlob(*self.mergeScalerState(SegmentScaler.NAME, firstFit))
 
-            if max_segments is not None:
-                padded_tracks[i, :num_segments,
-                              :] = flattened_segments[:max_segments]
-            else:
-                padded_tracks.append(flattened_segments)
+    def padTracks(self, segment_matrices, max_segments=None, scaler=None):
+        """
+        segment_matrices: [(track_id, (n_segments, 31) matrix)] as returned by getSegmentMatrices
+        scaler: SegmentScaler applied to the real segments, padding stays 0
+        """
+        if max_segments is None:
+            if scaler is None:
+                return [matrix for _, matrix in segment_matrices]
+            return [scaler.transform(matrix, copy=True) for _, matrix in segment_matrices]
+
+        padded_tracks = np.zeros(
+            (len(segment_matrices), max_segments, SEGMENT_SIZE), dtype=np.float32)
+        for i, (_, matrix) in enumerate(segment_matrices):
+            num_segments = min(len(matrix), max_segments)
+            padded_tracks[i, :num_segments, :] = matrix[:num_segments]
+            if scaler is not None:
+                scaler.transform(padded_tracks[i, :num_segments, :])
 
         return padded_tracks
 
-    def preprocess_tracks(self, track_ids, max_segments=None, userid=None):
-        if userid is None:
-            tracks = self.getTracks(
-                track_ids) if track_ids is not None else self.getValidTracks()
-        else:
+    def padSegmentMatrices(self, max_segments=None, scaler=None, track_ids=None, userid=None, chunk_size=256):
+        """
+        Streaming padTracks: (float32 (n_tracks, max_segments, 31) array, track_ids, n_segments per track).
+        Two passes over streamSegmentMatrices, the first only counts the tracks and finds the longest,
+        the second pads chunk by chunk into the result, so at most one chunk is held besides it.
+        max_segments: None pads to the longest track
+        """
+        nTracks, longest = 0, 0
+        for chunk in self.streamSegmentMatrices(chunk_size, track_ids, userid):
+            nTracks += len(chunk)
+            longest = max([longest] + [len(matrix) for _, matrix in chunk])
+        if max_segments is None:
+            max_segments = longest
+
+        padded_tracks = np.zeros((nTracks, max_segments, SEGMENT_SIZE), dtype=np.float32)
+        trackids, lengths = [], []
+        for chunk in self.streamSegmentMatrices(chunk_size, track_ids, userid):
+            for track_id, matrix in chunk[:nTracks - len(trackids)]:  # tracks stored between the passes wait for the next run
+                i = len(trackids)
+                num_segments = min(len(matrix), max_segments)
+                padded_tracks[i, :num_segments, :] = matrix[:num_segments]
+                if scaler is not None:
+                    scaler.transform(padded_tracks[i, :num_segments, :])
+                trackids.append(track_id)
+                lengths.append(len(matrix))
+        return padded_tracks[:len(trackids)], trackids, lengths
+
+    def preprocess_tracks(self, track_ids, max_segments=None, userid=None, scale=False):
+        """
+        scale: apply the persisted SegmentScaler. The deployed model was trained on unscaled segments,
+        only turn it on together with a retrained model and a model1.MODEL_VERSION bump.
+        """
+        if userid is not None:
             print(f"getting tracks for user: {userid}")
-            tracks = self.getValidUserTracks(userid)
-
-        decoded_tracks = self.decodeTracks(tracks)
-        self.scaleFeatures(decoded_tracks, ['start', 'duration', 'confidence', 'loudness_start',
-                                            'loudness_max', 'loudness_max_time', 'loudness_end'])
-
-        # This some ugly ass code ngl
-        padded_tracks = self.padTracks(decoded_tracks, ['start', 'duration', 'confidence', 'loudness_start',
-                                                        'loudness_max', 'loudness_max_time', 'loudness_end'], max_segments)
+        scaler = self.getSegmentScaler() if scale else None
+        if max_segments is not None:
+            padded_tracks, trakids, _ = self.padSegmentMatrices(max_segments, scaler, track_ids, userid)
+            return padded_tracks, trakids
 
-        trakids = [track[0] for track in decoded_tracks]
+        segment_matrices = self.getSegmentMatrices(track_ids, userid=userid)
+        padded_tracks = self.padTracks(segment_matrices, max_segments, scaler)
+        trakids = [track_id for track_id, _ in segment_matrices]
 
         return padded_tracks, trakids
 
+    def missingTracks(self, track_ids):
+        """
+        Set-based bTrackExits: returns, in input order, the track_ids that have no valid analysis stored.
+        The candidates go through a temp table so it is one query no matter how many there are.
+        """
+        track_ids = list(dict.fromkeys(track_ids))
+        if not track_ids:
+            return []
+        with self.conn as conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS candidate_tracks (track_id TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM candidate_tracks')
+            conn.executemany('INSERT INTO candidate_tracks (track_id) VALUES (?)', ((t,) for t in track_ids))
+            rows = conn.execute("""
+            SELECT candidate_tracks.track_id FROM candidate_tracks
+            LEFT JOIN tracks ON tracks.track_id = candidate_tracks.track_id AND tracks.status = 'ok'
+            WHERE tracks.track_id IS NULL
+            """).fetchall()
+            conn.execute('DELETE FROM candidate_tracks')
+        missing = {row[0] for row in rows}
+        return [track_id for track_id in track_ids if track_id in missing]
+
     def bTrackExits(self, track_id):
         with self.conn as conn:
             sql = 'SELECT 1 FROM tracks WHERE track_id = ?'
@@ -272,13 +872,54 @@ class Storage:
             conn.execute(sql, values)
             conn.commit()
 
-    def updateTrackTensor(self, track_id, track_tensor):
+    def updateTrackTensor(self, track_id, track_tensor, model_version=0):
         with self.conn:
             self.conn.execute("""
             UPDATE tracks
             SET track_tensor = ?
             WHERE track_id = ?;
-            """, (pickle.dumps(track_tensor), track_id))
+            """, (encodeArray(track_tensor, model_version), track_id))
+
+    def updateTrackTensors(self, track_tensors, model_version=0, batch_size=500):
+        """
+        Bulk version of updateTrackTensor.
+        track_tensors: iterable of (track_id, track_tensor)
+        """
+        rows = ((encodeArray(track_tensor, model_version), track_id) for track_id, track_tensor in track_tensors)
+        for batch in _batched(rows, batch_size):
+            with self.conn as conn:
+                conn.executemany('UPDATE tracks SET track_tensor = ? WHERE track_id = ?;', batch)
+
+    def migrateTrackTensors(self, batch_size=200):
+        """
+        One-off: rewrites pickled track tensors in the array blob format.
+        Anything that does not unpickle to an array (e.g. old placeholder strings) is cleared.
+        """
+        nConverted, nCleared = 0, 0
+        while True:
+            with self.conn as conn:
+                rows = conn.execute(
+                    "SELECT track_id, track_tensor FROM tracks WHERE track_tensor IS NOT NULL AND substr(track_tensor, 1, 4) != ? LIMIT ?",
+                    (MAGIC, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for track_id, blob in rows:
+                try:
+                    # the pickles were written by updateTrackTensor itself, this is the last time we load one
+                    tensor = pickle.loads(blob) if isinstance(blob, bytes) else None
+                except Exception:
+                    tensor = None
+                if isinstance(tensor, np.ndarray):
+                    updates.append((encodeArray(tensor), track_id))
+                    nConverted += 1
+                else:
+                    updates.append((None, track_id))
+                    nCleared += 1
+            with self.conn as conn:
+                conn.executemany('UPDATE tracks SET track_tensor = ? WHERE track_id = ?', updates)
+        print(f"Converted {nConverted} track tensors, cleared {nCleared}")
+        return nConverted
 
     # Tracks - Delete
     def deleteTrack(self, track_id):
@@ -379,19 +1020,32 @@ class Storage:
         # TODO check what data it is (track, artist, etc..) and store if possible
         raise NotImplementedError
 
-    def addTrackSafe(self, track_id, track_data=None, track_tensor=None, user_id=None):
+    def addTrackSafe(self, track_id, track_data=None, track_tensor=None, user_id=None, track_segments=None, status=None):
         """
         If the track already exists, updates its data; otherwise, adds a new track.
+        track_segments: encodeSegments blob, extracted from track_data when not given
+        status: trackStatus of track_data, derived from track_data when not given
         """
+        if (track_segments is None or status is None) and track_data is not None:
+            decoded = self.decodeTracks([(track_id, track_data)])
+            decoded_data = decoded[0][1] if decoded else {'error': 'invalid json'}
+            if track_segments is None:
+                track_segments = encodeSegments(decoded_data)
+            if status is None:
+                status = trackStatus(decoded_data)
+        if status is None:
+            status = TRACK_PENDING
+
         with self.conn as conn:
             # We assume track_id is the PRIMARY KEY. If not, modify accordingly.
             sql = '''
-            INSERT INTO tracks (track_id, track_data, track_tensor)
-            VALUES (?, ?, ?)
+            INSERT INTO tracks (track_id, track_data, track_tensor, track_segments, status)
+            VALUES (?, ?, ?, ?, ?)
             ON CONFLICT(track_id)
-            DO UPDATE SET track_data=excluded.track_data, track_tensor=excluded.track_tensor;
+            DO UPDATE SET track_data=excluded.track_data, track_tensor=excluded.track_tensor,
+                          track_segments=excluded.track_segments, status=excluded.status;
             '''
-            conn.execute(sql, (track_id, track_data, track_tensor))
+            conn.execute(sql, (track_id, self.deflateTrackData(track_data), track_tensor, track_segments, status))
 
             if track_data is not None and user_id is not None:
                 sql = '''
@@ -418,20 +1072,60 @@ class Storage:
             conn.execute(sql, (user_id, track_id, token))
             conn.commit()
 
-    def getTracksData(self):
-        tracks_data = []
-
-        for track_id, track_data in self.getValidTracks():
-            try:
-                decoded_data = json.loads(track_data)
-                tracks_data.append((track_id, decoded_data))
-            except json.JSONDecodeError:
-                # Fake data
-                pass
+    def addTracksBulk(self, tracks: Iterable[Tuple], user_id=None, batch_size=500):
+        """
+        Bulk version of addTrackSafe, commits once per batch_size tracks.
+        tracks: iterable of (track_id, track_data, track_tensor, track_segments, status), see encodeTrack
+        Returns the number of tracks written.
+        """
+        sql = '''
+        INSERT INTO tracks (track_id, track_data, track_tensor, track_segments, status)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(track_id)
+        DO UPDATE SET track_data=excluded.track_data, track_tensor=excluded.track_tensor,
+                      track_segments=excluded.track_segments, status=excluded.status;
+        '''
+        nTracks = 0
+        for batch in _batched(tracks, batch_size):
+            batch = [(row[0], self.deflateTrackData(row[1])) + tuple(row[2:]) for row in batch]
+            with self.conn as conn:
+                conn.executemany(sql, batch)
+            nTracks += len(batch)
+
+        if nTracks and user_id is not None:
+            with self.conn as conn:
+                conn.execute('UPDATE users SET last_data_updated = ? WHERE user_id = ?;',
+                             (datetime.datetime.now(), user_id))
+        return nTracks
+
+    def addUserTracksBulk(self, user_tracks: Iterable[Tuple], batch_size=500):
+        """
+        Bulk version of addUserTrackSafe, commits once per batch_size rows.
+        user_tracks: iterable of (user_id, track_id, token)
+        Returns the number of rows written.
+        """
+        sql = '''
+        INSERT INTO user_tracks (user_id, track_id, token)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, track_id)
+        DO UPDATE SET token=excluded.token;
+        '''
+        nRows = 0
+        for batch in _batched(user_tracks, batch_size):
+            with self.conn as conn:
+                conn.executemany(sql, batch)
+            nRows += len(batch)
+        return nRows
 
-        return tracks_data
+    def getTracksData(self):
+        return [track for chunk in self.streamValidTracks() for track in chunk]
 
 
 if __name__ == "__main__":
+    import sys
     s = Storage()
     s.createTables()
+    if 'backfill' in sys.argv[1:]:
+        s.backfillSegments()
+    if 'migrate-tensors' in sys.argv[1:]:
+        s.migrateTrackTensors()
@@ -0,0 +1,106 @@
+from typing import Dict, Optional
+import threading
+import time
+from spoticolor.auth import refresh_grant
+from spoticolor import metrics
+
+# TokenManager.refresh without a stale header: refresh whatever the current one is
+ANY_HEADER = object()
+
+
+class _Token:
+    __slots__ = ('header', 'refresh_token', 'expires_at', 'lock')
+
+    def __init__(self, header, refresh_token, expires_at):
+        self.header = header
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at  # time.time() the access token expires, None if unknown
+        self.lock = threading.Lock()
+
+
+class TokenManager:
+    """
+    Process wide access tokens keyed by user, shared by every SpotifyAPI instance and queue worker of that user.
+    Tokens are refreshed `margin` seconds before they expire, so requests don't go out with an expired token,
+    and concurrent refreshes of the same user collapse into one call to the accounts service.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_instance(**kwargs):
+        """ kwargs configure the manager the first time it is created """
+        if TokenManager._instance is None:
+            with TokenManager._lock:
+                if TokenManager._instance is None:
+                    TokenManager._instance = TokenManager(**kwargs)
+        return TokenManager._instance
+
+    def __init__(self, margin: float = 60.0):
+        """
+        margin: seconds before expiry a token is refreshed
+        """
+        self.margin = margin
+        self.tokens: Dict[str, _Token] = {}
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self._tokens_lock = threading.Lock()
+
+    def register(self, user_key: str, header: Dict[str, str], refresh_token: str, expires_in: Optional[float] = None):
+        """
+        Adds the token of a user. Without expires_in (e.g. a header restored from the flask session)
+        a token the manager already holds for the user is kept, since it is at least as new.
+        header None (only the refresh token is known) is refreshed on first use.
+        """
+        expires_at = time.time() + expires_in if expires_in is not None else None
+        if header is None:
+            expires_at = 0.0
+        with self._tokens_lock:
+            token = self.tokens.get(user_key)
+            if token is None:
+                self.tokens[user_key] = _Token(header, refresh_token, expires_at)
+                return
+        if expires_in is not None or token.refresh_token != refresh_token:
+            with token.lock:
+                token.header, token.refresh_token, token.expires_at = header, refresh_token, expires_at
+
+    def needsRefresh(self, user_key: str) -> bool:
+        token = self.tokens.get(user_key)
+        return token is not None and token.expires_at is not None and time.time() >= token.expires_at - self.margin
+
+    def header(self, user_key: str) -> Optional[Dict[str, str]]:
+        """ Current header of the user, refreshed first if it is about to expire """
+        token = self.tokens.get(user_key)
+        if token is None:
+            return None
+        if self.needsRefresh(user_key):
+            self.refresh(user_key, token.header)
+        return token.header
+
+    def refresh(self, user_key: str, stale_header=ANY_HEADER) -> bool:
+        """
+        Refreshes the user's access token. stale_header is the header the caller saw fail or expire,
+        if another thread already replaced it this returns right away with the new one in place.
+        """
+        token = self.tokens.get(user_key)
+        if token is None:
+            return False
+        with token.lock:
+            if stale_header is not ANY_HEADER and token.header != stale_header:
+                return True
+            grant = refresh_grant(token.refresh_token)
+            if grant is None:
+                self.failed_refreshes += 1
+                metrics.TOKEN_REFRESHES.inc(result='failed')
+                return False
+            token.header = grant['header']
+            token.expires_at = time.time() + grant['expires_in']
+            # spotify may rotate the refresh token
+            token.refresh_token = grant.get('refresh_token') or token.refresh_token
+            self.refreshes += 1
+            metrics.TOKEN_REFRESHES.inc(result='ok')
+            return True
+
+    def forget(self, user_key: str):
+        with self._tokens_lock:
+            self.tokens.pop(user_key, None)
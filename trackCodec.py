@@ -0,0 +1,169 @@
+from typing import Dict, List, Optional
+import argparse
+import struct
+import threading
+import time
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always there
+    zstandard = None
+
+
+# Compressed track_data blob: magic (3s) | codec (uint8) | dictionary id (uint32) | compressed json
+# Uncompressed track_data stays plain json TEXT, so old rows need no conversion to be readable.
+MAGIC = b'SCZ'
+_HEADER = struct.Struct('<3sBI')
+ZLIB = 1
+ZSTD = 2
+CODECS = {'zlib': ZLIB, 'zstd': ZSTD}
+ZLIB_MAX_DICT = 32768  # zlib only looks back 32KB
+# levels cheap enough for the ingest path, the offline rewrite (main) can afford e.g. --level 19
+DEFAULT_LEVELS = {ZLIB: 6, ZSTD: 3}
+
+
+class TrackCodec:
+    """
+    Compresses / decompresses audio analysis json with an optional shared trained dictionary.
+    Compressor objects are kept per thread since zstd ones are not thread safe.
+    level: compression level, any level decompresses with the same dictionary
+    """
+    def __init__(self, codec=ZSTD, dict_id=0, dictionary: Optional[bytes] = None, level=None):
+        if codec == ZSTD and zstandard is None:
+            raise RuntimeError("zstd track codec needs the zstandard package")
+        self.codec = codec
+        self.dict_id = dict_id
+        self.dictionary = dictionary
+        self.level = level if level is not None else DEFAULT_LEVELS[codec]
+        self._local = threading.local()
+        self._header = _HEADER.pack(MAGIC, codec, dict_id)
+
+    def withLevel(self, level) -> 'TrackCodec':
+        """ Same codec and dictionary compressing at level """
+        return TrackCodec(self.codec, self.dict_id, self.dictionary, level)
+
+    def _zstdDict(self):
+        return zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+
+    def compress(self, text) -> bytes:
+        data = text.encode('utf-8') if isinstance(text, str) else bytes(text)
+        if self.codec == ZLIB:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary) if self.dictionary \
+                else zlib.compressobj(self.level)
+            return self._header + compressor.compress(data) + compressor.flush()
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._zstdDict())
+        return self._header + compressor.compress(data)
+
+    def decompress(self, blob) -> bytes:
+        """ Raises ValueError on corrupt data, like json.loads does on bad json """
+        payload = memoryview(blob)[_HEADER.size:]
+        try:
+            if self.codec == ZLIB:
+                decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+                return decompressor.decompress(payload) + decompressor.flush()
+            decompressor = getattr(self._local, 'decompressor', None)
+            if decompressor is None:
+                decompressor = self._local.decompressor = zstandard.ZstdDecompressor(dict_data=self._zstdDict())
+            return decompressor.decompress(payload)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt zlib track data: {e}")
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise ValueError(f"Corrupt zstd track data: {e}")
+            raise
+
+
+def isCompressed(track_data) -> bool:
+    return isinstance(track_data, (bytes, memoryview)) and bytes(track_data[:3]) == MAGIC
+
+
+def readHeader(blob):
+    """ Returns (codec, dict_id) of a compressed track_data blob """
+    _, codec, dict_id = _HEADER.unpack_from(blob, 0)
+    return codec, dict_id
+
+
+def trainDictionary(codec, samples: List[bytes], dict_size=112640) -> bytes:
+    """
+    zstd trains a real dictionary, for zlib the most common prefix material of the samples is used as zdict.
+    """
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstd track codec needs the zstandard package")
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    # zlib prefers the most useful strings at the end of the dictionary
+    per_sample = max(ZLIB_MAX_DICT // max(len(samples), 1), 512)
+    return b''.join(sample[:per_sample] for sample in samples)[-ZLIB_MAX_DICT:]
+
+
+def report(codec: TrackCodec, samples: List[bytes]) -> Dict[str, float]:
+    """
+    Size and decode time of the samples raw vs compressed.
+    """
+    compressed = [codec.compress(sample) for sample in samples]
+    raw_size = sum(len(s) for s in samples)
+    compressed_size = sum(len(c) for c in compressed)
+
+    t0 = time.perf_counter()
+    for sample in samples:
+        json.loads(sample)
+    t1 = time.perf_counter()
+    for blob in compressed:
+        json.loads(codec.decompress(blob))
+    t2 = time.perf_counter()
+    return {
+        'samples': len(samples),
+        'raw_bytes': raw_size,
+        'compressed_bytes': compressed_size,
+        'ratio': raw_size / max(compressed_size, 1),
+        'raw_decode_ms': (t1 - t0) * 1000 / max(len(samples), 1),
+        'compressed_decode_ms': (t2 - t1) * 1000 / max(len(samples), 1),
+    }
+
+
+def main():
+    from spoticolor.storage import Storage
+
+    parser = argparse.ArgumentParser(description="Compress tracks.track_data with a shared trained dictionary")
+    parser.add_argument('--db', default='data.db')
+    parser.add_argument('--codec', choices=list(CODECS), default='zstd' if zstandard is not None else 'zlib')
+    parser.add_argument('--level', type=int, default=None,
+                        help="level the existing tracks are rewritten with, e.g. 19, new tracks always use the cheap default")
+    parser.add_argument('--samples', type=int, default=1000, help="tracks used to train the dictionary and for the report")
+    parser.add_argument('--dict-size', type=int, default=112640)
+    parser.add_argument('--dry-run', action='store_true', help="only print the size / decode time report")
+    parser.add_argument('--vacuum', action='store_true', help="VACUUM afterwards so the db file actually shrinks")
+    args = parser.parse_args()
+
+    storage = Storage(args.db)
+    storage.createTables()
+    samples = storage.sampleTrackData(args.samples)
+    if not samples:
+        print("No tracks to compress")
+        return
+
+    codec_id = CODECS[args.codec]
+    dictionary = trainDictionary(codec_id, samples, args.dict_size)
+    for name, codec in (('no dictionary', TrackCodec(codec_id, level=args.level)),
+                        ('dictionary', TrackCodec(codec_id, dictionary=dictionary, level=args.level))):
+        stats = report(codec, samples)
+        print(f"{args.codec} ({name}): {stats['raw_bytes']} -> {stats['compressed_bytes']} bytes "
+              f"(x{stats['ratio']:.2f}) over {stats['samples']} tracks, decode "
+              f"{stats['raw_decode_ms']:.2f}ms -> {stats['compressed_decode_ms']:.2f}ms per track")
+    if args.dry_run:
+        return
+
+    storage.addTrackCodec(codec_id, dictionary)
+    nTracks = storage.compressTracks(level=args.level)
+    print(f"Compressed {nTracks} tracks")
+    if args.vacuum:
+        with storage.conn as conn:
+            conn.execute('VACUUM')
+
+
+if __name__ == "__main__":
+    main()